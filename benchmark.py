@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+
+"""benchmark
+
+Time the model building pipeline (flight log ingestion, term generation,
+SystemIdentification solve/model_noise/simulate and the model_fit_exp4
+parameter_find_5 search) on synthetic flight logs (lib/synth_log.py) of
+increasing size.  The dask svd solve is compared against the streamed Gram
+matrix solvers (lib/gram.py) for speed and the difference in A.  The logs are generated from a fixed seed so every run (and
+every commit) times exactly the same work, results are printed as a table and
+optionally written to a json file along with the git commit.
+
+"""
+
+import argparse
+import ast
+import contextlib
+import io
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import warnings
+
+import matplotlib
+matplotlib.use("Agg")   # plots are created but never shown
+from matplotlib import pyplot as plt
+import dask
+import dask.array as da
+import numpy as np
+
+from lib import gram
+from lib import perf
+from lib import quaternion
+from lib import selection
+from lib import validation
+from lib import synth_log
+from lib.history import history_map
+from lib.state_mgr import StateManager
+from lib.system_id import SystemIdentification
+from lib.traindata import TrainData
+
+# command line arguments
+parser = argparse.ArgumentParser(description="model build benchmark")
+parser.add_argument("--sizes", default="1e4,1e5,1e6", help="comma separated list of log sizes (imu samples), up to 1e7")
+parser.add_argument("--imu-hz", type=float, default=50, help="imu rate of the synthetic logs")
+parser.add_argument("--noise", type=float, default=1.0, help="sensor noise scale of the synthetic logs")
+parser.add_argument("--seed", type=int, default=0, help="random seed of the synthetic logs")
+parser.add_argument("--records-max", type=float, default=1e5, help="largest log to also ingest with the (slow) per-record parser")
+parser.add_argument("--find-max", type=float, default=1e6, help="largest log to run parameter_find_5 on")
+parser.add_argument("--find-terms", type=int, default=6, help="number of candidate terms for parameter_find_5")
+parser.add_argument("--json", help="write results to this json file")
+parser.add_argument("--verbose", action='store_true', help="show the output of the benchmarked code")
+args = parser.parse_args()
+
+train_states = [
+    "aileron", "elevator", "rudder", "throttle",
+    "aileron*qbar", "aileron*vc_mps", "elevator*qbar", "elevator*vc_mps",
+    "rudder*qbar", "rudder*vc_mps", "throttle/vc_mps", "throttle*qbar",
+    "one", "p", "q", "r", "dp", "dq", "dr",
+    "p*qbar", "q*qbar", "r*qbar", "ax", "ay", "az", "ay*qbar", "az/qbar",
+    "bgx", "bgy", "bgz", "abs(ay)", "q_term1",
+    "vc_mps", "alpha_deg", "beta_deg", "alpha_deg*qbar", "beta_deg*qbar",
+    "qbar", "1/vc_mps", "1/qbar",
+    "p_1", "q_1", "r_1", "ax_1", "elevator_1", "elevator_2",
+]
+output_states = [ "p", "q", "r", "vc_mps", "beta_deg" ]
+find_state = "p"
+
+# model_fit_exp4.py runs at module level, so pull just the functions needed
+# for parameter_find_5 out of it
+def script_functions(path, names, env):
+    with open(path, "r") as f:
+        tree = ast.parse(f.read(), filename=path)
+    nodes = [ node for node in tree.body if isinstance(node, ast.FunctionDef) and node.name in names ]
+    exec(compile(ast.Module(body=nodes, type_ignores=[]), path, "exec"), env)
+    return env
+
+def git_commit():
+    try:
+        commit = subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL, text=True).strip()
+        dirty = subprocess.call(["git", "diff", "--quiet", "HEAD"], stderr=subprocess.DEVNULL) != 0
+        return commit + ("-dirty" if dirty else "")
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+propagate_src, propagate_dst = history_map(train_states)
+exp4 = script_functions(os.path.join(os.path.dirname(os.path.abspath(__file__)), "model_fit_exp4.py"),
+                        [ "solve", "simulate", "rms", "parameter_find_5" ],
+                        { "np": np, "da": da, "plt": plt, "gram": gram, "selection": selection,
+                          "propagate_src": propagate_src, "propagate_dst": propagate_dst })
+
+warnings.simplefilter("ignore")
+results = []
+for size in [ int(float(s)) for s in args.sizes.split(",") ]:
+    print("Benchmark: %d samples" % size)
+    work_dir = tempfile.TemporaryDirectory()
+    perf.timer = perf.StageTimer()
+    timer = perf.timer
+    quiet = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(io.StringIO())
+    quiet_err = contextlib.nullcontext() if args.verbose else contextlib.redirect_stderr(io.StringIO())
+    with quiet, quiet_err:
+        log_dir = os.path.join(work_dir.name, "log_%d" % size)
+        with timer.stage("generate log", records=size):
+            data = synth_log.generate(size, imu_hz=args.imu_hz, noise=args.noise, seed=args.seed)
+        with timer.stage("write log", records=size):
+            synth_log.write_csv(data, log_dir)
+        del data
+
+        # rotating velocity and gravity into the body frame (the derived
+        # states): per sample quaternions vs the batch quaternion and
+        # direction cosine versions
+        rng = np.random.default_rng(args.seed)
+        phi, the, psi = rng.uniform(-1, 1, (3, size))
+        vel_ned = rng.normal(size=(size, 3))
+        g_ned = np.array( [0.0, 0.0, 9.81] )
+        if size <= args.records_max:
+            with timer.stage("rotate (scalar)", records=size):
+                for i in range(size):
+                    ned2body = quaternion.eul2quat(phi[i], the[i], psi[i])
+                    quaternion.transform(ned2body, vel_ned[i])
+                    quaternion.transform(ned2body, g_ned)
+        with timer.stage("rotate (quat batch)", records=size):
+            ned2body = quaternion.eul2quat_batch(phi, the, psi)
+            quaternion.transform_batch(ned2body, vel_ned)
+            quaternion.transform_batch(ned2body, g_ned)
+        with timer.stage("rotate (dcm batch)", records=size):
+            ned2body = quaternion.eul2dcm_batch(phi, the, psi)
+            quaternion.dcm_transform_batch(ned2body, vel_ned)
+            quaternion.dcm_transform_batch(ned2body, g_ned)
+        del phi, the, psi, vel_ned, ned2body
+
+        # ingestion: load_flightdata() from the log on disk (flight_loader,
+        # batch parse, session store and the train states) with a fresh
+        # cache, and the per-record parse of the same log for comparison
+        state_mgr = StateManager("wing")
+        state_mgr.set_is_flying_thresholds(10, 7)
+        train_data = TrainData()
+        train_data.cache_dir = os.path.join(work_dir.name, "cache_%d" % size)
+        with timer.stage("load_flightdata (batch)", records=size):
+            train_data.load_flightdata([log_dir], "wing", False, False, state_mgr, [{}], train_states, batch=True, jobs=1)
+        traindata = train_data.states
+        imu_dt = train_data.dt
+        if size <= args.records_max:
+            records_mgr = StateManager("wing")
+            records_mgr.set_is_flying_thresholds(10, 7)
+            stats, records_matrix = TrainData().parse_file(log_dir, "wing", False, False, records_mgr)
+            del records_matrix
+
+            # the real time path: the state vector of the current state
+            # written into a preallocated buffer, as a simulation step would
+            state_vector = np.zeros(len(train_states))
+            with timer.stage("state vector (realtime)", records=size):
+                for i in range(size):
+                    records_mgr.gen_state_vector(train_states, out=state_vector)
+
+        # model fit
+        state_mgr.set_state_names([], train_states, output_states)
+        train_idx = list(range(len(train_states)))
+        output_idx = [ train_states.index(s) for s in output_states ]
+        samples = traindata.shape[1]
+        sysid = SystemIdentification("wing")
+        with timer.stage("solve", records=samples) as stage:
+            sysid.solve(traindata, train_idx, output_idx)
+            stage["shape"] = sysid.X.shape
+        gram_diff = {}
+        for method in [ "cholesky", "pinv" ]:
+            gram_sysid = SystemIdentification("wing")
+            with timer.stage("solve (%s)" % method, records=samples) as stage:
+                gram_sysid.solve(traindata, train_idx, output_idx, method=method)
+                stage["shape"] = sysid.X.shape
+            gram_diff[method] = float(np.max(np.abs(gram_sysid.A - sysid.A)))
+        for method in [ "ridge", "tsvd" ]:
+            gram_sysid = SystemIdentification("wing")
+            with timer.stage("solve (%s gcv)" % method, records=samples) as stage:
+                gram_sysid.solve(traindata, train_idx, output_idx, method=method, names=train_states)
+                stage["shape"] = sysid.X.shape
+        del gram_sysid
+
+        # every output over its own terms (all but itself and its history):
+        # one svd solve per output vs one batched Gram pass
+        fits = {}
+        for name in output_states:
+            fits[name] = [ x for x in train_states if x != name and not x.startswith(name + "_") ]
+        with timer.stage("solve outputs (svd each)", records=samples):
+            each = {}
+            for name in fits:
+                each[name] = exp4["solve"](traindata, [ train_states.index(x) for x in fits[name] ], [ train_states.index(name) ])[0]
+        with timer.stage("solve outputs (batched)", records=samples):
+            batched = gram.solve_outputs(traindata, fits, train_states)
+        outputs_diff = max([ float(np.max(np.abs(each[name] - batched[name]["coeff"]))) for name in fits ])
+        with timer.stage("cross validation", records=samples):
+            cv = validation.CrossValidation(traindata, train_states, output_states, folds=5)
+            cv_result = cv.evaluate(free_run=size <= args.records_max)
+        with timer.stage("ranges", records=samples):
+            sysid.ranges(train_states)
+        with timer.stage("model_noise", records=samples):
+            sysid.model_noise(state_mgr, traindata, output_idx, imu_dt)
+        with timer.stage("simulate", records=samples):
+            sysid.simulate(traindata, train_states, train_idx, output_idx)
+        plt.close("all")
+        if size <= args.find_max:
+            candidates = [ s for s in train_states if s != find_state ][:args.find_terms]
+            exclude_states = [ s for s in train_states if s not in candidates ]
+            with timer.stage("parameter_find_5", records=samples):
+                order = exp4["parameter_find_5"](traindata, train_states, find_state, ["one"], exclude_states, fast=False)
+            plt.close("all")
+            with timer.stage("parameter_find_5 (fast)", records=samples):
+                fast_order = exp4["parameter_find_5"](traindata, train_states, find_state, ["one"], exclude_states)
+            plt.close("all")
+
+    # checksums of the work done, these should only change when the results
+    # of the pipeline change
+    if size > args.find_max:
+        order = fast_order = None
+    result = {
+        "size": size,
+        "samples": samples,
+        "checks": {
+            "traindata_sum": float(np.nansum(traindata)),
+            "A_sum": float(np.nansum(sysid.A)),
+            "A_cholesky_diff": gram_diff["cholesky"],
+            "A_pinv_diff": gram_diff["pinv"],
+            "A_outputs_diff": outputs_diff,
+            "cv_one_step_rms": { name: r["one_step_rms"] for name, r in cv_result.items() },
+            "find_order": order,
+            "find_order_fast_matches": order == fast_order,
+        },
+        "stages": timer.totals(),
+    }
+    results.append(result)
+    timer.report()
+    del traindata, train_data, sysid
+    work_dir.cleanup()
+
+output = {
+    "commit": git_commit(),
+    "python": platform.python_version(),
+    "numpy": np.__version__,
+    "dask": dask.__version__,
+    "platform": platform.platform(),
+    "cpus": os.cpu_count(),
+    "args": vars(args),
+    "results": results,
+}
+if args.json:
+    with open(args.json, "w") as f:
+        json.dump(output, f, indent=4)
+    print("wrote:", args.json)
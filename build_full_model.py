@@ -12,15 +12,21 @@ Engineering and Mechanics, UAV Lab.
 """
 
 import argparse
+from concurrent.futures import ProcessPoolExecutor
 import json
 from math import cos, pi, sin
 from matplotlib import pyplot as plt
+import multiprocessing
 import numpy as np
+import os
 from tqdm import tqdm  # pip install tqdm
 
 from flightdata import flight_loader, flight_interp
 
 from lib.constants import d2r, r2d, kt2mps
+from lib import gram
+from lib import perf
+from lib import validation
 from lib.state_mgr import StateManager
 from lib.system_id import SystemIdentification
 from lib.traindata import TrainData
@@ -32,6 +38,15 @@ parser.add_argument("--write", required=True, help="write model file name")
 parser.add_argument("--vehicle", default="wing", choices=["wing", "quad"], help="vehicle type represented by data file")
 parser.add_argument("--invert-elevator", action='store_true', help="invert direction of elevator")
 parser.add_argument("--invert-rudder", action='store_true', help="invert direction of rudder")
+parser.add_argument("--batch", action='store_true', help="vectorized (whole log at a time) flight data ingestion")
+parser.add_argument("--jobs", type=int, help="number of flight logs to parse and conditions to fit in parallel (default: number of cpus)")
+parser.add_argument("--history", type=int, default=4, help="number of past values kept for the _n history terms (1-9)")
+parser.add_argument("--solver", default="svd", choices=["svd", "cholesky", "pinv", "ridge", "tsvd"], help="fit with the dask svd of the whole train data or by solving its streamed Gram matrices (cholesky, pinv, regularized: ridge, tsvd)")
+parser.add_argument("--select", default="gcv", choices=["gcv", "holdout"], help="how the ridge/tsvd regularization of each output is picked")
+parser.add_argument("--update", action='store_true', help="refresh the --write model: add the flight logs to its saved fit statistics instead of fitting from scratch")
+parser.add_argument("--forget", type=float, default=1.0, help="forgetting factor per sample (< 1 weights recent samples more, e.g. 0.99999)")
+parser.add_argument("--cv", type=int, default=0, help="cross validate each condition's fit with this many folds (whole flights when there are enough, time blocks otherwise)")
+parser.add_argument("--timing-json", help="write the stage timing summary to this json file")
 args = parser.parse_args()
 
 # # load the flight data
@@ -304,7 +319,7 @@ elif args.vehicle == "quad":
         #"p", "q", "r",               # imu (body) rates
     ]
 
-state_mgr = StateManager(args.vehicle)
+state_mgr = StateManager(args.vehicle, history=args.history)
 # train_states = inceptor_terms + inceptor_airdata_terms + inertial_terms + airdata_terms
 train_states = inceptor_airdata_terms + inertial_terms + airdata_terms
 print("train_states:", len(train_states), train_states)
@@ -314,7 +329,8 @@ state_mgr.set_is_flying_thresholds(12*kt2mps, 7*kt2mps) # bob ross
 # state_mgr.set_is_flying_thresholds(75*kt2mps, 65*kt2mps) # sr22
 
 train_data = TrainData()
-train_data.load_flightdata(args.flight, args.vehicle, args.invert_elevator, args.invert_rudder, state_mgr, conditions, train_states)
+with perf.timer.stage("ingest (total)"):
+    train_data.load_flightdata(args.flight, args.vehicle, args.invert_elevator, args.invert_rudder, state_mgr, conditions, train_states, batch=args.batch, jobs=args.jobs)
 
 train_idx = []
 for x in train_states:
@@ -508,9 +524,10 @@ for x in output_states:
 print("Conditions report:")
 for i, cond in enumerate(conditions):
     print(i, cond)
-    if len(train_data.cond_list[i]):
-        print("  Number of states:", len(train_data.cond_list[i][0]))
-        print("  Input state vectors:", len(train_data.cond_list[i]))
+    index = train_data.cond_index[i]
+    if len(index):
+        print("  Number of states:", index.shape[-1])
+        print("  Input state vectors:", len(index) if index.ndim == 2 else len(train_states))
 
 # stub / top of our model structure to save
 root_dict = {
@@ -523,40 +540,174 @@ root_dict = {
 sysid_list = [None] * len(conditions)
 print("sysid_list:", sysid_list)
 
-# create a solution for each condition
-for i, cond in enumerate(conditions):
+# the fit statistics (Gram matrices) of each condition, saved next to the
+# model so later flights can be added without refitting the old ones
+stats_info = {
+    "train_states": train_states,
+    "output_states": output_states,
+    "conditions": conditions,
+}
+stats_list = [None] * len(conditions)
+solver = args.solver
+saved_conditions = []
+if args.update:
+    if not os.path.exists(gram.stats_path(args.write)):
+        print("ERROR: no saved fit statistics to update (build the model without --update first):", gram.stats_path(args.write))
+        quit()
+    stats_list, info = gram.load(gram.stats_path(args.write), len(conditions))
+    if info != json.loads(json.dumps(stats_info)):
+        print("ERROR: the saved fit statistics don't match the train states and conditions of this model:", gram.stats_path(args.write))
+        quit()
+    # conditions without new samples are kept from the model being refreshed
+    if os.path.exists(args.write):
+        with open(args.write, "r") as f:
+            saved_conditions = json.load(f)["conditions"]
+if (args.update or args.forget < 1) and solver == "svd":
+    solver = "cholesky"
+
+# A refreshed condition without new samples: A is solved from its saved fit
+# statistics and the rest of its entry (ranges, noise, contributors) is kept
+# from the saved model.  Returns the same as fit_condition() (without
+# simulation estimates.)
+def refit_saved(i):
+    mark = len(perf.timer.stages)
+    cond = json.loads(json.dumps(conditions[i]))
+    print("no new samples, solving the saved fit statistics (%d samples)" % stats_list[i].samples)
+    condition_dict = { "condition": conditions[i] }
+    for saved in saved_conditions:
+        if saved["condition"] == cond:
+            condition_dict = saved
+    if "parameters" not in condition_dict:
+        print("WARNING: condition", cond, "is not in the saved model, its ranges are missing")
+    sysid = SystemIdentification(args.vehicle)
+    with perf.timer.stage("solve", records=stats_list[i].samples):
+        sysid.solve_stats(stats_list[i], output_idx, solver, train_states, select=args.select)
+    condition_dict["A"] = sysid.A.flatten().tolist()
+    if solver in gram.regularized:
+        condition_dict["regularization"] = sysid.selection
+    return condition_dict, sysid, stats_list[i], None, perf.timer.stages[mark:]
+
+# Fit one condition, returns None if it has no samples (nor saved fit
+# statistics) or (condition_dict, sysid, fit statistics, simulation
+# estimates, perf stages.)  The plots are left to the caller.  Conditions
+# are independent so they can be fitted in worker processes (forked, so they
+# see the session loaded above.)
+def fit_condition(i):
+    cond = conditions[i]
     print(i, cond)
-    traindata = train_data.cond_list[i]
-    if not len(traindata):
-        continue
+    # the condition's samples are read from the memory mapped session states
+    # as they are needed (no copy of the whole condition) unless its data
+    # was replaced with a matrix of its own
+    index = train_data.cond_index[i]
+    if not len(index):
+        if stats_list[i] is not None:
+            return refit_saved(i)
+        return None
+    if index.ndim == 2:
+        traindata = index
+        columns = None
+        segments = None
+    else:
+        traindata = train_data.states
+        columns = index
+        segments = train_data.segments
+    mark = len(perf.timer.stages)
     dt = train_data.dt
 
     condition_dict = { "condition": cond }
 
     sysid = SystemIdentification(args.vehicle)
-    sysid_list[i] = sysid
 
     # sysid.correlation_report_2(state_mgr, traindata, None)
     # sysid.compute_lift_curve(coeff)
     # sysid.fit(state_mgr, traindata)
-    sysid.solve(traindata, train_idx, output_idx)
-    sysid.ranges(train_states)
-    sysid.model_noise(state_mgr, traindata, output_idx, dt)
-    sysid.analyze(state_mgr, train_states, output_idx)
-
-    sysid.simulate(traindata, train_states, train_idx, output_idx)
+    samples = index.shape[-1]
+    with perf.timer.stage("gram", records=samples):
+        stats = gram.accumulate(traindata, train_idx, output_idx, columns, forget=args.forget, segments=segments)
+    if stats_list[i] is not None:
+        print("adding %d samples to the %d saved" % (stats.samples, stats_list[i].samples))
+        stats = stats_list[i].append(stats)
+    with perf.timer.stage("solve", records=samples) as stage:
+        if solver == "svd":
+            sysid.solve(traindata, train_idx, output_idx, columns=columns, segments=segments)
+        else:
+            sysid.solve(traindata, train_idx, output_idx, method=solver, names=train_states, stats=stats,
+                        select=args.select, columns=columns, segments=segments)
+        stage["shape"] = (len(train_idx), len(sysid.x_idx))
+    with perf.timer.stage("ranges", records=samples):
+        sysid.ranges(train_states)
+    with perf.timer.stage("model_noise", records=samples):
+        sysid.model_noise(state_mgr, traindata, output_idx, dt)
+    with perf.timer.stage("analyze"):
+        sysid.analyze(state_mgr, train_states, output_idx)
+
+    with perf.timer.stage("simulate", records=samples):
+        est = sysid.simulate(traindata, train_states, train_idx, output_idx, plot=False, columns=columns)
     condition_dict["parameters"] = sysid.parameters
     condition_dict["A"] = sysid.A.flatten().tolist()
+    if args.cv:
+        with perf.timer.stage("cross validation", records=samples):
+            if columns is not None:
+                cv = validation.CrossValidation(traindata, train_states, output_states, folds=args.cv,
+                                                segments=segments, columns=columns)
+            else:
+                cv = validation.CrossValidation(traindata, train_states, output_states, folds=args.cv)
+            condition_dict["validation"] = cv.evaluate(method="pinv" if solver == "pinv" else "cholesky")
+            cv.report(condition_dict["validation"])
+    if solver in gram.regularized:
+        condition_dict["regularization"] = sysid.selection
+
+    # the train data (views) and the pair index are not needed (or wanted,
+    # from a worker) anymore
+    sysid.X = None
+    sysid.Y = None
+    sysid.traindata = None
+    sysid.x_idx = None
+    sysid.y_idx = None
+    return condition_dict, sysid, stats, est, perf.timer.stages[mark:]
+
+# create a solution for each condition, in worker processes when there is
+# more than one condition to fit (and fork is available), results in
+# condition order either way
+fit_list = [ i for i in range(len(conditions)) if len(train_data.cond_index[i]) or stats_list[i] is not None ]
+jobs = min(args.jobs if args.jobs is not None else os.cpu_count(), len(fit_list))
+if jobs > 1 and "fork" in multiprocessing.get_all_start_methods():
+    print("fitting", len(fit_list), "conditions with", jobs, "worker processes ...")
+    with ProcessPoolExecutor(max_workers=jobs, mp_context=multiprocessing.get_context("fork")) as executor:
+        results = list(executor.map(fit_condition, range(len(conditions))))
+    for result in results:
+        if result is not None:
+            perf.timer.stages.extend(result[4])
+else:
+    results = [ fit_condition(i) for i in range(len(conditions)) ]
+
+for i, result in enumerate(results):
+    if result is None:
+        continue
+    condition_dict, sysid_list[i], stats_list[i], est, stages = result
     root_dict["conditions"].append(condition_dict)
 
+# all the plots once the fits are done
+with perf.timer.stage("plots"):
+    for i, result in enumerate(results):
+        if result is not None and result[3] is not None:
+            sysid_list[i].plot_simulation(train_data.cond_list[i], train_states, output_idx, result[3], show=False)
+    plt.show()
+
 # the median delta t from the data log is important to include
 # with the state transition matrix because the state
 # transition matrix coefficients assume this value for
 # realtime performance.
 
-f = open(args.write, "w")
-json.dump(root_dict, f, indent=4)
-f.close()
+with perf.timer.stage("save model"):
+    f = open(args.write, "w")
+    json.dump(root_dict, f, indent=4)
+    f.close()
+    gram.save(gram.stats_path(args.write), stats_list, stats_info)
+
+perf.timer.report()
+if args.timing_json:
+    perf.timer.save_json(args.timing_json)
 
 if False:
     # for each condition, show a running estimate of output states.  Feed the
@@ -0,0 +1,42 @@
+# Growable buffer for collecting state vectors one sample at a time.
+#
+# Samples are written in place into preallocated fixed size chunks (no python
+# lists of floats, no reallocation as the buffer grows.)  finish() copies the
+# chunks into the final [rows x samples] array releasing each chunk as it
+# goes, so peak memory stays close to the size of the final matrix.
+
+import numpy as np
+
+class ColumnBuffer():
+    def __init__(self, rows, dtype=np.float64, chunk_size=65536):
+        self.rows = rows
+        self.dtype = dtype
+        self.chunk_size = chunk_size
+        self.chunks = []
+        self.current = np.empty( (chunk_size, rows), dtype=dtype )
+        self.count = 0
+
+    def __len__(self):
+        return len(self.chunks) * self.chunk_size + self.count
+
+    def append(self, values):
+        if self.count >= self.chunk_size:
+            self.chunks.append(self.current)
+            self.current = np.empty( (self.chunk_size, self.rows), dtype=self.dtype )
+            self.count = 0
+        self.current[self.count] = values
+        self.count += 1
+
+    # returns the collected samples as a [rows x samples] array, the buffer
+    # is empty afterwards
+    def finish(self):
+        result = np.empty( (self.rows, len(self)), dtype=self.dtype )
+        offset = 0
+        while len(self.chunks):
+            chunk = self.chunks.pop(0)
+            result[:,offset:offset+self.chunk_size] = chunk.T
+            offset += self.chunk_size
+        result[:,offset:] = self.current[:self.count].T
+        self.current = np.empty( (self.chunk_size, self.rows), dtype=self.dtype )
+        self.count = 0
+        return result
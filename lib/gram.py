@@ -0,0 +1,369 @@
+# Streaming normal equations for the state transition fit.
+#
+# SystemIdentification.solve() fits Y = A * X where X is the [terms x
+# samples] train data and Y the output rows shifted by one sample.  Everything
+# the least squares fit needs is in the small products
+#
+#   XX = X * X.T    [terms x terms]
+#   YX = Y * X.T    [outputs x terms]
+#   YY = Y * Y.T    [outputs x outputs]
+#
+# which are summed here (with the sums of X and Y for the means) a slice of
+# samples at a time (O(samples * terms^2) work, no copy of the whole X) and
+# solved with
+#
+#   A = YX * inv(XX)
+#
+# by Cholesky (or a pseudo inverse when XX is singular.)  Squaring X squares
+# its condition number, so report() shows how well conditioned the fit is.
+#
+# The products are also the sufficient statistics of the fit: they are saved
+# next to the model json (save(), load()) and new flights or a live stream
+# are added to them (append(), update()) to refresh A without going back to
+# the old data.  With a forgetting factor < 1 each sample's weight decays by
+# forget per newer sample (recursive least squares with exponential
+# forgetting, solved from the running products.)
+
+import json
+import numpy as np
+import os
+
+# regularized solve methods (see Gram.path()) and their default lambda grids
+regularized = {
+    "ridge": np.logspace(-10, 0, 21),
+    "tsvd": np.logspace(-8, -1, 15),
+}
+
+class Gram():
+    def __init__(self, inputs, outputs, forget=1.0):
+        self.XX = np.zeros( (inputs, inputs) )
+        self.YX = np.zeros( (outputs, inputs) )
+        self.YY = np.zeros( (outputs, outputs) )
+        self.sx = np.zeros(inputs)      # sums of X and Y (means)
+        self.sy = np.zeros(outputs)
+        self.samples = 0
+        self.forget = forget
+
+    # add the sample pairs of X [terms x n] and Y [outputs x n] (in time
+    # order, after the samples already added)
+    def add(self, X, Y):
+        X = np.asarray(X, dtype=np.float64)
+        Y = np.asarray(Y, dtype=np.float64)
+        n = X.shape[1]
+        if self.forget < 1:
+            # the newest sample has weight 1
+            decay = self.forget ** n
+            self.XX *= decay
+            self.YX *= decay
+            self.YY *= decay
+            self.sx *= decay
+            self.sy *= decay
+            weight = self.forget ** np.arange(n-1, -1, -1)
+            Xw = X * weight
+            Yw = Y * weight
+            self.XX += Xw @ X.T
+            self.YX += Y @ Xw.T
+            self.YY += Yw @ Y.T
+            self.sx += np.sum(Xw, axis=1)
+            self.sy += np.sum(Yw, axis=1)
+        else:
+            self.XX += X @ X.T
+            self.YX += Y @ X.T
+            self.YY += Y @ Y.T
+            self.sx += np.sum(X, axis=1)
+            self.sy += np.sum(Y, axis=1)
+        self.samples += n
+
+    # add one sample pair x [terms], y [outputs], O(terms^2)
+    def update(self, x, y):
+        if self.forget < 1:
+            self.XX *= self.forget
+            self.YX *= self.forget
+            self.YY *= self.forget
+            self.sx *= self.forget
+            self.sy *= self.forget
+        self.XX += np.outer(x, x)
+        self.YX += np.outer(y, x)
+        self.YY += np.outer(y, y)
+        self.sx += x
+        self.sy += y
+        self.samples += 1
+
+    # add the products of samples that came after ours (a new flight
+    # accumulated with the same terms), decaying ours by its forgetting
+    # factor
+    def append(self, other):
+        decay = other.forget ** other.samples if other.forget < 1 else 1.0
+        self.XX = self.XX * decay + other.XX
+        self.YX = self.YX * decay + other.YX
+        self.YY = self.YY * decay + other.YY
+        self.sx = self.sx * decay + other.sx
+        self.sy = self.sy * decay + other.sy
+        self.samples += other.samples
+        self.forget = other.forget
+        return self
+
+    # the columns are scaled to unit norm before factoring (the scaled
+    # problem has the same solution and a much better condition number
+    # when the terms have very different magnitudes, qbar vs p)
+    def _scale(self):
+        diag = np.diag(self.XX).copy()
+        diag[diag <= 0] = 1
+        return 1 / np.sqrt(diag)
+
+    # conditioning of the fit: the eigenvalues of the scaled XX are the
+    # squared singular values of the scaled X
+    def conditioning(self, rcond=1e-7):
+        scale = self._scale()
+        eig, vec = np.linalg.eigh(self.XX * np.outer(scale, scale))
+        eig = np.maximum(eig, 0)
+        top = eig[-1] if len(eig) else 0
+        if top > 0:
+            cond = np.sqrt(top / eig[0]) if eig[0] > 0 else np.inf
+        else:
+            cond = np.inf
+        rank = int(np.sum(eig > top * rcond**2)) if top > 0 else 0
+        return { "cond": cond, "rank": rank, "eig": eig, "vectors": vec }
+
+    # print the condition number and, for a rank deficient fit, the terms
+    # that make up the (nearly) dependent combinations
+    def report(self, names=None, rcond=1e-7):
+        info = self.conditioning(rcond)
+        terms = len(self.XX)
+        print("gram: samples: %d terms: %d rank: %d cond(X): %.3g cond(XX): %.3g"
+              % (self.samples, terms, info["rank"], info["cond"], info["cond"]**2))
+        if names is not None:
+            for k in range(terms - info["rank"]):
+                v = info["vectors"][:,k]
+                idx = np.argsort(-np.abs(v))[:4]
+                combo = " ".join([ "%+.2f*%s" % (v[j], names[j]) for j in idx if abs(v[j]) > 0.01 ])
+                print("  dependent terms:", combo)
+        return info
+
+    # A [outputs x terms].  method: "cholesky" (falls back to "pinv" when XX
+    # isn't positive definite) or "pinv" (minimum norm solution of the unit
+    # norm scaled terms, singular values of the scaled X below rcond * the
+    # largest are dropped.)  rcond can't go much below 1e-8: XX only holds
+    # the squared singular values.
+    def solve(self, method="cholesky", rcond=1e-7):
+        scale = self._scale()
+        XXs = self.XX * np.outer(scale, scale)
+        YXs = self.YX * scale
+        if method == "cholesky":
+            from scipy.linalg import LinAlgError, cho_factor, cho_solve
+            try:
+                factor = cho_factor(XXs)
+                # a tiny pivot is a (nearly) dependent term
+                if np.min(np.abs(np.diag(factor[0]))) > rcond:
+                    return cho_solve(factor, YXs.T).T * scale
+                print("gram: XX is nearly singular, using the pseudo inverse")
+            except LinAlgError:
+                print("gram: XX is not positive definite, using the pseudo inverse")
+        elif method != "pinv":
+            raise Exception("unknown gram solve method:", method)
+        # XX = X X^T has the squared singular values of X
+        return (YXs @ np.linalg.pinv(XXs, rcond=rcond**2, hermitian=True)) * scale
+
+    # take out the products of a subset of the samples (a holdout slice
+    # summed separately), only exact without forgetting
+    def remove(self, other):
+        if self.forget < 1 or other.forget < 1:
+            raise Exception("can't remove samples from a Gram with forgetting")
+        result = Gram(0, 0)
+        result.XX = self.XX - other.XX
+        result.YX = self.YX - other.YX
+        result.YY = self.YY - other.YY
+        result.sx = self.sx - other.sx
+        result.sy = self.sy - other.sy
+        result.samples = self.samples - other.samples
+        return result
+
+    # the products of a subset of the terms and outputs (index lists)
+    def subset(self, inputs, outputs):
+        result = Gram(0, 0, self.forget)
+        result.XX = self.XX[np.ix_(inputs, inputs)]
+        result.YX = self.YX[np.ix_(outputs, inputs)]
+        result.YY = self.YY[np.ix_(outputs, outputs)]
+        result.sx = self.sx[inputs]
+        result.sy = self.sy[outputs]
+        result.samples = self.samples
+        return result
+
+    # the np.std() of the error of each output (what model_fit_exp4 calls
+    # rms) and that as a percentage of the np.std() of the output itself
+    def error_std(self, A):
+        n = max(self.samples, 1)
+        mean = (self.sy - A @ self.sx) / n
+        std = np.sqrt(np.maximum(self.error(A) / n - mean * mean, 0))
+        y_mean = self.sy / n
+        y_std = np.sqrt(np.maximum(np.diag(self.YY) / n - y_mean * y_mean, 0))
+        with np.errstate(divide="ignore", invalid="ignore"):
+            percent = 100 * std / y_std
+        return std, percent
+
+    # sum of squared residuals of each output of a model A fitted to the
+    # samples these products were summed over:
+    #   |Y - A X|^2 = tr(YY) - 2 tr(A YX^T) + tr(A XX A^T)
+    def error(self, A):
+        return np.diag(self.YY) - 2 * np.sum(A * self.YX, axis=1) + np.sum((A @ self.XX) * A, axis=1)
+
+    # Regularized solutions for a whole grid of lambdas from one eigen
+    # decomposition of the scaled XX (s^2 = the squared singular values of the
+    # unit norm scaled X):
+    #   "ridge": Tikhonov, 1/s^2 becomes 1/(s^2 + lambda), lambda is relative
+    #            to the unit norm terms (XX scaled to a unit diagonal)
+    #   "tsvd":  singular values below lambda * the largest are dropped
+    # Returns a dict of the lambdas, A [lambdas x outputs x terms], the
+    # effective number of parameters (dof) and the residuals (rss [lambdas x
+    # outputs]) of each solution.
+    def path(self, lambdas, method="ridge"):
+        scale = self._scale()
+        eig, vec = np.linalg.eigh(self.XX * np.outer(scale, scale))
+        eig = np.maximum(eig, 0)
+        B = (self.YX * scale) @ vec
+        B2 = B * B
+        result = { "lambdas": np.asarray(lambdas, dtype=np.float64), "A": [], "dof": [], "rss": [] }
+        for lam in result["lambdas"]:
+            if method == "ridge":
+                keep = eig + lam > 0
+                f = np.where(keep, 1 / np.where(keep, eig + lam, 1), 0)
+            elif method == "tsvd":
+                keep = eig > lam**2 * eig[-1]
+                f = np.where(keep, 1 / np.where(keep, eig, 1), 0)
+            else:
+                raise Exception("unknown regularization method:", method)
+            result["A"].append( ((B * f) @ vec.T) * scale )
+            result["dof"].append( np.sum(eig * f) )
+            result["rss"].append( np.diag(self.YY) - 2 * B2 @ f + B2 @ (f * f * eig) )
+        for key in [ "A", "dof", "rss" ]:
+            result[key] = np.array(result[key])
+        return result
+
+    # generalized cross validation score [lambdas x outputs] of a path, lower
+    # is better: samples * rss / (samples - dof)^2
+    def gcv(self, path):
+        dof = np.minimum(path["dof"], self.samples - 1)
+        return self.samples * path["rss"] / ((self.samples - dof)**2)[:,None]
+
+# The solution with the lowest score [lambdas x outputs] picked for each
+# output on its own, returns A and the chosen lambda index of each output
+def choose(path, score, names=None):
+    best = np.argmin(score, axis=0)
+    A = np.array( [ path["A"][k,i] for i, k in enumerate(best) ] )
+    for i, k in enumerate(best):
+        name = names[i] if names is not None else i
+        print("  %s: lambda: %.3g dof: %.1f score: %.6g" % (name, path["lambdas"][k], path["dof"][k], score[k,i]))
+    return A, best
+
+# mask of the sample pairs (x[k], y[k] > x[k]) that lie in the same segment
+# ([start, end) sample ranges, see TrainData.segments)
+def same_segment(x, y, segments):
+    segments = np.asarray(segments, dtype=int).reshape(-1, 2)
+    seg = np.searchsorted(segments[:,0], x, side="right") - 1
+    return (seg >= 0) & (y < segments[np.maximum(seg, 0), 1])
+
+# The sample pairs of the fit of a [train states x samples] matrix: x and y
+# (the sample after x) index arrays into its samples.  columns optionally
+# selects the samples (a condition's index into the session), in which case
+# consecutive selected samples are paired like the condition matrix would be.
+# segments: only pair samples of the same segment (no pairs across a
+# landing or from one flight log to the next.)
+def pair_index(size, columns=None, segments=None):
+    if columns is None:
+        x = np.arange(max(size - 1, 0))
+        y = x + 1
+    else:
+        columns = np.asarray(columns)
+        x = columns[:-1]
+        y = columns[1:]
+    if segments is not None:
+        same = same_segment(x, y, segments)
+        x = x[same]
+        y = y[same]
+    return x, y
+
+# states[rows][:,idx] (idx ascending), a slice when idx is one contiguous
+# run so a memory mapped matrix is read without a fancy index
+def take(states, rows, idx):
+    if len(idx) and idx[-1] - idx[0] == len(idx) - 1:
+        return states[rows, idx[0]:idx[-1]+1]
+    return states[np.ix_(rows, idx)]
+
+# Sum the products over a [train states x samples] matrix (an in memory array
+# or the memory mapped session states) chunk samples at a time.  X is the
+# includes_idx rows, Y the solutions_idx rows of the sample after (see
+# pair_index(), columns selects the samples, segments limits the pairs.)
+def accumulate(states, includes_idx, solutions_idx, columns=None, chunk=1 << 16, forget=1.0, segments=None):
+    gram = Gram(len(includes_idx), len(solutions_idx), forget)
+    x, y = pair_index(states.shape[1], columns, segments)
+    for start in range(0, len(x), chunk):
+        X = take(states, includes_idx, x[start:start+chunk])
+        Y = take(states, solutions_idx, y[start:start+chunk])
+        gram.add(X, Y)
+    return gram
+
+# Fit several outputs, each over its own terms, from one pass over a [train
+# states x samples] matrix: fits is a dict of output -> list of terms (row
+# indices, or names looked up in names.)  The Gram matrix of all the terms and
+# outputs is summed once, every output is then solved from its own block.
+# Returns a dict of output -> { "terms", "coeff" (one per term), "rms" (the
+# np.std() of the one step error), "percent" (rms as a percentage of the
+# np.std() of the output) }
+def solve_outputs(states, fits, names=None, method="cholesky", columns=None, chunk=1 << 16):
+    def index(x):
+        return names.index(x) if names is not None else x
+    outputs = list(fits.keys())
+    terms = []
+    for output in outputs:
+        for term in fits[output]:
+            if index(term) not in terms:
+                terms.append(index(term))
+    gram = accumulate(states, terms, [ index(x) for x in outputs ], columns, chunk)
+    result = {}
+    for i, output in enumerate(outputs):
+        sub = gram.subset([ terms.index(index(x)) for x in fits[output] ], [i])
+        A = sub.solve(method)
+        std, percent = sub.error_std(A)
+        result[output] = { "terms": list(fits[output]), "coeff": A[0], "rms": std[0], "percent": percent[0] }
+    return result
+
+# the statistics file kept next to a model json
+def stats_path(model_path):
+    return os.path.splitext(model_path)[0] + "_gram.npz"
+
+# save the Gram of each condition (None for conditions without data) along
+# with a json serializable description (state names, conditions) that load()
+# returns to check the statistics still match the model being built
+def save(path, grams, info):
+    arrays = { "info": np.array(json.dumps(info)) }
+    for i, gram in enumerate(grams):
+        if gram is None:
+            continue
+        arrays["XX_%d" % i] = gram.XX
+        arrays["YX_%d" % i] = gram.YX
+        arrays["YY_%d" % i] = gram.YY
+        arrays["sx_%d" % i] = gram.sx
+        arrays["sy_%d" % i] = gram.sy
+        arrays["samples_%d" % i] = gram.samples
+        arrays["forget_%d" % i] = gram.forget
+    tmp = path + ".tmp.npz"
+    np.savez(tmp, **arrays)
+    os.replace(tmp, path)
+
+def load(path, conditions):
+    grams = []
+    with np.load(path) as arrays:
+        info = json.loads(str(arrays["info"]))
+        for i in range(conditions):
+            if "XX_%d" % i not in arrays:
+                grams.append(None)
+                continue
+            gram = Gram(0, 0, float(arrays["forget_%d" % i]))
+            gram.XX = arrays["XX_%d" % i]
+            gram.YX = arrays["YX_%d" % i]
+            gram.YY = arrays["YY_%d" % i]
+            gram.sx = arrays["sx_%d" % i]
+            gram.sy = arrays["sy_%d" % i]
+            gram.samples = int(arrays["samples_%d" % i])
+            grams.append(gram)
+    return grams, info
@@ -0,0 +1,86 @@
+# Fixed size ring buffer for the state manager history channels.
+#
+# Replaces the "self.gyros = [gyros] + self.gyros[:num]" history lists: the
+# entries live in one preallocated [depth x shape] array, push() overwrites
+# the oldest entry in place (no allocation per sample) and h[n] is the value
+# n steps back (h[0] is the current value.)  Negative lags count from the
+# oldest entry like python lists, so h[-1] is the oldest value kept.
+
+import numpy as np
+
+from lib.terms import split_history
+
+class History():
+    def __init__(self, depth, shape=(), dtype=np.float64):
+        self.depth = depth
+        self.buf = np.zeros( (depth,) + tuple(shape), dtype=dtype )
+        self.head = 0   # buf index of the current value
+
+    def __len__(self):
+        return self.depth
+
+    def push(self, value):
+        self.head -= 1
+        if self.head < 0:
+            self.head = self.depth - 1
+        self.buf[self.head] = value
+
+    def __getitem__(self, n):
+        if n >= self.depth or n < -self.depth:
+            raise IndexError("history lag out of range:", n)
+        return self.buf[(self.head + n) % self.depth]
+
+    # h[n][component] in one lookup without creating an array view, for the
+    # real time path
+    def item(self, n, component=None):
+        if n >= self.depth or n < -self.depth:
+            raise IndexError("history lag out of range:", n)
+        if component is None:
+            return self.buf[(self.head + n) % self.depth]
+        return self.buf[(self.head + n) % self.depth, component]
+
+    def __iter__(self):
+        for n in range(self.depth):
+            yield self[n]
+
+    # all the entries in lag order as a [depth x shape] array (a copy)
+    def values(self):
+        return np.concatenate( [self.buf[self.head:], self.buf[:self.head]] )
+
+    # forget the past: every lag reads the current value (the history at the
+    # start of a segment of flight doesn't reach back before it)
+    def reset(self):
+        self.buf[:] = self.buf[self.head].copy()
+
+    # replace the contents with values given in lag order, missing entries
+    # read as zeros
+    def fill(self, values):
+        self.buf[:] = 0
+        self.head = 0
+        count = min(len(values), self.depth)
+        if count:
+            self.buf[:count] = np.asarray(values)[:count]
+
+# The history terms of a state list as (src, dst) index arrays: state dst
+# (x_n) is state src (x_n-1, or x itself for x_1) one step later, so a
+# simulation steps all the history forward at once with
+#
+#   data[dst, i+1] = data[src, i]
+#
+# instead of looping over the terms every step.
+def history_map(state_list):
+    src = []
+    dst = []
+    for i, name in enumerate(state_list):
+        root, n = split_history(name)
+        if n == 0:
+            continue
+        if n == 1:
+            parent = root
+        else:
+            parent = root + "_%d" % (n-1)
+        if parent not in state_list:
+            raise Exception("requested state history without finding the current state:", name, "->", parent)
+        src.append( state_list.index(parent) )
+        dst.append( i )
+    return np.array(src, dtype=int), np.array(dst, dtype=int)
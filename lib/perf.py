@@ -0,0 +1,107 @@
+# Lightweight timing of the model build stages.
+#
+# Wrap a stage in a "with" block and fill in whatever else is known about it:
+#
+#   from lib import perf
+#   with perf.timer.stage("solve", records=len(traindata[0])) as stage:
+#       sysid.solve(...)
+#       stage["shape"] = sysid.X.shape
+#
+# Each stage records wall and cpu time (cpu includes finished worker
+# processes), records/sec when a record count is given, and the peak
+# resident memory of the run so far.  report() prints a summary table and
+# save_json() writes the same thing for comparing runs.
+
+from contextlib import contextmanager
+import json
+import os
+import platform
+import sys
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None     # not available on windows
+
+# peak resident memory (MB) of this process and its finished children
+def peak_rss_mb():
+    if resource is None:
+        return None
+    self_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    child_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    if sys.platform == "darwin":
+        scale = 1024 * 1024     # bytes
+    else:
+        scale = 1024            # KB
+    return max(self_rss, child_rss) / scale
+
+def _cpu_time():
+    t = os.times()
+    return t.user + t.system + t.children_user + t.children_system
+
+class StageTimer():
+    def __init__(self):
+        self.stages = []
+
+    @contextmanager
+    def stage(self, name, records=None):
+        result = { "name": name }
+        if records is not None:
+            result["records"] = records
+        start_wall = time.perf_counter()
+        start_cpu = _cpu_time()
+        try:
+            yield result
+        finally:
+            result["wall_sec"] = time.perf_counter() - start_wall
+            result["cpu_sec"] = _cpu_time() - start_cpu
+            if result.get("records") and result["wall_sec"] > 0:
+                result["records_per_sec"] = result["records"] / result["wall_sec"]
+            result["peak_rss_mb"] = peak_rss_mb()
+            if "shape" in result:
+                result["shape"] = [ int(n) for n in result["shape"] ]
+            self.stages.append(result)
+
+    # stage totals by name (in the order first seen)
+    def totals(self):
+        totals = {}
+        for stage in self.stages:
+            name = stage["name"]
+            if name not in totals:
+                totals[name] = { "name": name, "count": 0, "wall_sec": 0, "cpu_sec": 0, "records": 0 }
+            total = totals[name]
+            total["count"] += 1
+            total["wall_sec"] += stage["wall_sec"]
+            total["cpu_sec"] += stage["cpu_sec"]
+            total["records"] += stage.get("records", 0)
+            total["peak_rss_mb"] = stage["peak_rss_mb"]
+            if "shape" in stage:
+                total["shape"] = stage["shape"]
+        for total in totals.values():
+            if total["records"] and total["wall_sec"] > 0:
+                total["records_per_sec"] = total["records"] / total["wall_sec"]
+        return list(totals.values())
+
+    def report(self):
+        print("Timing summary:")
+        print("  %-24s %5s %10s %10s %12s %9s  %s" % ("stage", "count", "wall (s)", "cpu (s)", "records/s", "rss (MB)", "shape"))
+        for total in self.totals():
+            rate = "%12.0f" % total["records_per_sec"] if "records_per_sec" in total else "%12s" % "-"
+            rss = "%9.1f" % total["peak_rss_mb"] if total["peak_rss_mb"] is not None else "%9s" % "-"
+            shape = "x".join([ str(n) for n in total["shape"] ]) if "shape" in total else ""
+            print("  %-24s %5d %10.3f %10.3f %s %s  %s" % (total["name"], total["count"], total["wall_sec"], total["cpu_sec"], rate, rss, shape))
+
+    def save_json(self, path):
+        result = {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "totals": self.totals(),
+            "stages": self.stages,
+        }
+        with open(path, "w") as f:
+            json.dump(result, f, indent=4)
+
+# shared by the whole run
+timer = StageTimer()
@@ -5,7 +5,8 @@ import math
 import numpy as np
 
 # computes a quaternion from the given euler angles
-def eul2quat(phi_rad, the_rad, psi_rad):
+# out: optional preallocated 4 element array to write the result into
+def eul2quat(phi_rad, the_rad, psi_rad, out=None):
     sin_psi = math.sin(psi_rad * 0.5)
     cos_psi = math.cos(psi_rad * 0.5)
     sin_the = math.sin(the_rad * 0.5)
@@ -13,7 +14,10 @@ def eul2quat(phi_rad, the_rad, psi_rad):
     sin_phi = math.sin(phi_rad * 0.5)
     cos_phi = math.cos(phi_rad * 0.5)
 
-    q = np.zeros(4)
+    if out is None:
+        q = np.zeros(4)
+    else:
+        q = out
     q[0] = cos_psi*cos_the*cos_phi + sin_psi*sin_the*sin_phi  
     q[1] = cos_psi*cos_the*sin_phi - sin_psi*sin_the*cos_phi
     q[2] = cos_psi*sin_the*cos_phi + sin_psi*cos_the*sin_phi  
@@ -40,16 +44,24 @@ def quat2eul(q):
     
     return phi_rad, the_rad, psi_rad
 
-def multiply(quaternion1, quaternion0):
+def multiply(quaternion1, quaternion0, out=None):
     """Return multiplication of two quaternions.
 
     >>> q = quaternion_multiply([4, 1, -2, 3], [8, -5, 6, 7])
     >>> np.allclose(q, [28, -44, -14, 48])
     True
 
+    out may be a preallocated 4 element array (either of the inputs too)
+
     """
     w0, x0, y0, z0 = quaternion0
     w1, x1, y1, z1 = quaternion1
+    if out is not None:
+        out[0], out[1], out[2], out[3] = (-x1*x0 - y1*y0 - z1*z0 + w1*w0,
+                                          x1*w0 + y1*z0 - z1*y0 + w1*x0,
+                                          -x1*z0 + y1*w0 + z1*x0 + w1*y0,
+                                          x1*y0 - y1*x0 + z1*w0 + w1*z0)
+        return out
     return np.array([-x1*x0 - y1*y0 - z1*z0 + w1*w0,
                      x1*w0 + y1*z0 - z1*y0 + w1*x0,
                      -x1*z0 + y1*w0 + z1*x0 + w1*y0,
@@ -73,9 +85,11 @@ def quaternion_imag(quaternion):
     """
     return np.array(quaternion[1:4], dtype=np.float64, copy=True)
 
-def transform(quat, v):
+def transform(quat, v, out=None):
     # Transform a vector from the current coordinate frame to a coordinate
     # frame rotated with the quaternion
+    if out is not None:
+        return _transform_into(quat, v, out, -1.0)
     r = 2.0 / np.dot(quat, quat)
     qimag = quaternion_imag(quat)
     qr = quaternion_real(quat)
@@ -84,9 +98,11 @@ def transform(quat, v):
     tmp3 = (r*qr)*np.cross(qimag, v)
     return tmp1 + tmp2 - tmp3
 
-def backTransform(quat, v):
+def backTransform(quat, v, out=None):
     # Transform a vector from the coordinate frame rotated with the
     # quaternion to the current coordinate frame
+    if out is not None:
+        return _transform_into(quat, v, out, 1.0)
 
     r = 2.0 / np.dot(quat, quat)
     qimag = quaternion_imag(quat)
@@ -96,3 +112,112 @@ def backTransform(quat, v):
     tmp3 = (r*qr)*np.cross(qimag, v)
     return tmp1 + tmp2 + tmp3
 
+# transform() written out element by element into a preallocated 3 element
+# array (out may be v itself): no temporary arrays, for the real time
+# simulation path.  sign is -1 for transform(), +1 for backTransform()
+def _transform_into(quat, v, out, sign):
+    q0, q1, q2, q3 = quat
+    v0, v1, v2 = v
+    r = 2.0 / (q0*q0 + q1*q1 + q2*q2 + q3*q3)
+    a = r*q0*q0 - 1.0
+    b = r*(q1*v0 + q2*v1 + q3*v2)
+    c = sign*r*q0
+    out[0], out[1], out[2] = (a*v0 + b*q1 + c*(q2*v2 - q3*v1),
+                              a*v1 + b*q2 + c*(q3*v0 - q1*v2),
+                              a*v2 + b*q3 + c*(q1*v1 - q2*v0))
+    return out
+
+
+# Array versions of the functions above: quaternions are [N x 4] arrays,
+# vectors [N x 3] (or a single 3 vector applied to every quaternion) and
+# angles length N arrays.  Results match the single versions to rounding.
+
+def eul2quat_batch(phi_rad, the_rad, psi_rad):
+    sin_psi = np.sin(psi_rad * 0.5)
+    cos_psi = np.cos(psi_rad * 0.5)
+    sin_the = np.sin(the_rad * 0.5)
+    cos_the = np.cos(the_rad * 0.5)
+    sin_phi = np.sin(phi_rad * 0.5)
+    cos_phi = np.cos(phi_rad * 0.5)
+
+    q = np.empty( (len(sin_psi), 4) )
+    q[:,0] = cos_psi*cos_the*cos_phi + sin_psi*sin_the*sin_phi
+    q[:,1] = cos_psi*cos_the*sin_phi - sin_psi*sin_the*cos_phi
+    q[:,2] = cos_psi*sin_the*cos_phi + sin_psi*cos_the*sin_phi
+    q[:,3] = sin_psi*cos_the*cos_phi - cos_psi*sin_the*sin_phi
+    return q
+
+# returns phi, the, psi arrays
+def quat2eul_batch(q):
+    q0 = q[:,0]
+    q1 = q[:,1]
+    q2 = q[:,2]
+    q3 = q[:,3]
+
+    m11 = 2*(q0*q0 + q1*q1) - 1
+    m12 = 2*(q1*q2 + q0*q3)
+    m13 = 2*(q1*q3 - q0*q2)
+    m23 = 2*(q2*q3 + q0*q1)
+    m33 = 2*(q0*q0 + q3*q3) - 1
+
+    psi_rad = np.arctan2(m12, m11)
+    the_rad = np.arcsin(-m13)
+    phi_rad = np.arctan2(m23, m33)
+    return phi_rad, the_rad, psi_rad
+
+def multiply_batch(quaternion1, quaternion0):
+    w0, x0, y0, z0 = quaternion0.T
+    w1, x1, y1, z1 = quaternion1.T
+    q = np.empty( (max(len(quaternion0), len(quaternion1)), 4) )
+    q[:,0] = -x1*x0 - y1*y0 - z1*z0 + w1*w0
+    q[:,1] = x1*w0 + y1*z0 - z1*y0 + w1*x0
+    q[:,2] = -x1*z0 + y1*w0 + z1*x0 + w1*y0
+    q[:,3] = x1*y0 - y1*x0 + z1*w0 + w1*z0
+    return q
+
+def _transform_batch(quat, v, sign):
+    v = np.asarray(v, dtype=np.float64)
+    r = 2.0 / np.einsum("ij,ij->i", quat, quat)
+    qimag = quat[:,1:4]
+    qr = quat[:,0]
+    dot = (qimag * v).sum(axis=1)
+    result = ((r*qr*qr - 1.0)[:,None]) * v
+    result += (r*dot)[:,None] * qimag
+    result += sign * (r*qr)[:,None] * np.cross(qimag, v)
+    return result
+
+def transform_batch(quat, v):
+    return _transform_batch(quat, v, -1.0)
+
+def backTransform_batch(quat, v):
+    return _transform_batch(quat, v, 1.0)
+
+# Direction cosine matrices [N x 3 x 3] of the euler angles: dcm[i] @ v
+# rotates an ned vector into the body frame (the same as transform() with
+# eul2quat()), without going through quaternions.
+def eul2dcm_batch(phi_rad, the_rad, psi_rad):
+    sin_phi = np.sin(phi_rad)
+    cos_phi = np.cos(phi_rad)
+    sin_the = np.sin(the_rad)
+    cos_the = np.cos(the_rad)
+    sin_psi = np.sin(psi_rad)
+    cos_psi = np.cos(psi_rad)
+
+    dcm = np.empty( (len(sin_phi), 3, 3) )
+    dcm[:,0,0] = cos_the*cos_psi
+    dcm[:,0,1] = cos_the*sin_psi
+    dcm[:,0,2] = -sin_the
+    dcm[:,1,0] = sin_phi*sin_the*cos_psi - cos_phi*sin_psi
+    dcm[:,1,1] = sin_phi*sin_the*sin_psi + cos_phi*cos_psi
+    dcm[:,1,2] = sin_phi*cos_the
+    dcm[:,2,0] = cos_phi*sin_the*cos_psi + sin_phi*sin_psi
+    dcm[:,2,1] = cos_phi*sin_the*sin_psi - sin_phi*cos_psi
+    dcm[:,2,2] = cos_phi*cos_the
+    return dcm
+
+# rotate [N x 3] vectors (or one 3 vector) with [N x 3 x 3] dcms
+def dcm_transform_batch(dcm, v):
+    v = np.asarray(v, dtype=np.float64)
+    if v.ndim == 1:
+        return dcm @ v
+    return np.einsum("nij,nj->ni", dcm, v)
@@ -0,0 +1,96 @@
+# Greedy forward selection of train state terms from their Gram matrix.
+#
+# parameter_find_5() (model_fit_exp4.py) grows the fit of one output a term
+# at a time: each round every remaining candidate is added to the chosen
+# terms, fitted, and the one leaving the smallest np.std() of the one step
+# error wins.  Fitting every candidate from scratch is a full solve over all
+# the samples per candidate per round.  Here the Gram matrix of all the terms
+# (lib/gram.py) is summed once and the chosen terms are kept as the Cholesky
+# factor L of their block G[S,S] (with z = L^-1 b[S], b = X y), so one round
+# scores every candidate c at once:
+#
+#   w   = L^-1 G[S,c]          the candidate against the chosen terms
+#   d   = G[c,c] - |w|^2       the part of the candidate that is new (pivot)
+#   z_c = (b[c] - w.z) / sqrt(d)
+#   rss = yy - |z|^2 - z_c^2   residual sum of squares with c added
+#
+# The error mean (for std = sqrt(rss/N - mean^2)) follows the same way from
+# the sums of the terms.  Adding the winner extends L by one row.
+
+import numpy as np
+from scipy.linalg import solve_triangular
+
+class ForwardSelection():
+    # gram: Gram of the terms against one output, include: term indices
+    # that are always in the fit
+    def __init__(self, gram, include=[], tol=1e-12):
+        self.G = gram.XX
+        self.b = gram.YX[0]
+        self.yy = gram.YY[0,0]
+        self.sx = gram.sx
+        self.sy = gram.sy[0]
+        self.samples = gram.samples
+        self.tol = tol
+        self.chosen = []    # terms in the order they were added
+        self.active = []    # chosen terms in the factor (not dependent)
+        self.L = np.zeros( (0, 0) )
+        self.z = np.zeros(0)
+        self.u = np.zeros(0)    # L^-1 sx[S]
+        for i in include:
+            self.add(i)
+
+    def _columns(self, candidates):
+        candidates = np.asarray(candidates, dtype=int)
+        if len(self.active):
+            w = solve_triangular(self.L, self.G[np.ix_(self.active, candidates)], lower=True)
+        else:
+            w = np.zeros( (0, len(candidates)) )
+        d = self.G[candidates, candidates] - np.sum(w * w, axis=0)
+        # candidates (nearly) in the span of the chosen terms add nothing
+        new = d > self.tol * np.maximum(self.G[candidates, candidates], 1e-300)
+        root = np.sqrt(np.where(new, d, 1))
+        z = np.where(new, (self.b[candidates] - self.z @ w) / root, 0)
+        u = np.where(new, (self.sx[candidates] - self.u @ w) / root, 0)
+        return w, root, z, u, new
+
+    # the residual sum of squares and the std of the error of the fit with
+    # each candidate added
+    def score(self, candidates):
+        w, root, z, u, new = self._columns(candidates)
+        rss = self.yy - self.z @ self.z - z * z
+        mean = (self.sy - (self.z @ self.u + z * u)) / self.samples
+        std = np.sqrt(np.maximum(rss / self.samples - mean * mean, 0))
+        return rss, std
+
+    def add(self, c):
+        w, root, z, u, new = self._columns([c])
+        self.chosen.append(c)
+        if not new[0]:
+            return
+        k = len(self.active)
+        L = np.zeros( (k+1, k+1) )
+        L[:k,:k] = self.L
+        L[k,:k] = w[:,0]
+        L[k,k] = root[0]
+        self.L = L
+        self.z = np.append(self.z, z[0])
+        self.u = np.append(self.u, u[0])
+        self.active.append(c)
+
+    # the fit coefficients of the chosen terms (0 for terms that depend on
+    # the ones chosen before them)
+    def coefficients(self):
+        a = np.zeros(len(self.chosen))
+        if len(self.active):
+            coeff = solve_triangular(self.L.T, self.z, lower=False)
+            for i, c in enumerate(self.active):
+                a[self.chosen.index(c)] = coeff[i]
+        return a
+
+    # choose the best remaining candidate, returns its position in
+    # candidates and the scores of all of them
+    def step(self, candidates):
+        rss, std = self.score(candidates)
+        best = int(np.argmin(std))
+        self.add(candidates[best])
+        return best, std
@@ -0,0 +1,167 @@
+# On disk columnar storage of parsed flight data.
+#
+# Each parsed flight log is stored as a directory with a small json manifest
+# and the raw channel frame of its flying samples (a [channels x samples]
+# .npy, see StateManager.frame_layout().)  The session (all the logs of a run
+# merged in file order) keeps the merged frame (and the sample ranges of each
+# continuous run of flight in it) and the [terms x samples] matrix of the
+# current train states that the flight conditions select their samples from,
+# the only copy of the computed terms.  Everything is opened with
+# np.load(mmap_mode=...) so startup is nearly instant, only the rows that are
+# actually used get read from disk, and sessions larger than ram can still be
+# fit.  Changing the list of train states copies the terms it shares with the
+# previous list and only computes the new ones.
+
+import json
+import os
+import shutil
+
+import numpy as np
+
+store_version = 4
+
+# copy on write: callers may modify their train data in place (filters,
+# experiments) without touching the files on disk.
+mmap_mode = "c"
+
+def _write_manifest(path, manifest):
+    tmp_file = os.path.join(path, "manifest.json.tmp")
+    with open(tmp_file, "w") as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(tmp_file, os.path.join(path, "manifest.json"))
+
+def _read_manifest(path):
+    manifest_file = os.path.join(path, "manifest.json")
+    if not os.path.exists(manifest_file):
+        return None
+    with open(manifest_file, "r") as f:
+        manifest = json.load(f)
+    if manifest.get("version") != store_version:
+        return None
+    return manifest
+
+# build the directory next to its final location and move it into place when
+# complete so an interrupted write never leaves a partial entry behind
+def _new_dir(path):
+    tmp_path = path + ".tmp%d" % os.getpid()
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+    return tmp_path
+
+def _replace_dir(tmp_path, path):
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.rename(tmp_path, path)
+
+def _layout_json(layout):
+    return [ [name, list(shape)] for name, shape in layout ]
+
+# save the parse of one flight log: frame is the [channels x samples] raw
+# channel matrix of its flying samples, segments the [start, end) sample
+# ranges of each continuous run of flight in it
+def save_entry(path, stats, frame, flight_format, layout, segments):
+    tmp_path = _new_dir(path)
+    np.save(os.path.join(tmp_path, "frame.npy"), frame)
+    manifest = {
+        "version": store_version,
+        "stats": stats,
+        "flight_format": flight_format,
+        "layout": _layout_json(layout),
+        "samples": int(frame.shape[1]),
+        "segments": segments,
+    }
+    _write_manifest(tmp_path, manifest)
+    _replace_dir(tmp_path, path)
+
+# returns the entry manifest (or None if there is no valid entry at path)
+def load_entry(path):
+    return _read_manifest(path)
+
+# memory map the frame of an entry
+def entry_frame(path):
+    return np.load(os.path.join(path, "frame.npy"), mmap_mode="r")
+
+# merge the per file frames (in order) into one session frame, written a
+# file at a time into a memory mapped file so the merge never needs the whole
+# session in ram.
+def save_session(path, entry_paths, keys, dt, dt_stats, flight_format, layout, dtype=np.float64):
+    tmp_path = _new_dir(path)
+    manifests = [ load_entry(entry_path) for entry_path in entry_paths ]
+    width = 0
+    for name, shape in layout:
+        width += int(np.prod(shape))
+    samples = 0
+    for manifest in manifests:
+        samples += manifest["samples"]
+    frame = np.lib.format.open_memmap(os.path.join(tmp_path, "frame.npy"), mode="w+",
+                                      dtype=dtype, shape=(width, samples))
+    offset = 0
+    segments = []
+    for entry_path, manifest in zip(entry_paths, manifests):
+        n = manifest["samples"]
+        if n:
+            frame[:,offset:offset+n] = entry_frame(entry_path)
+        for start, end in manifest["segments"]:
+            segments.append( [start + offset, end + offset] )
+        offset += n
+    frame.flush()
+    del frame
+    manifest = {
+        "version": store_version,
+        "keys": keys,
+        "dt": dt,
+        "dt_stats": dt_stats,
+        "flight_format": flight_format,
+        "layout": _layout_json(layout),
+        "samples": samples,
+        "segments": segments,
+        "states": None,
+    }
+    _write_manifest(tmp_path, manifest)
+    _replace_dir(tmp_path, path)
+
+# memory map the session frame if the session at path was built from exactly
+# these entries, returns (frame, manifest) or None
+def load_session(path, keys):
+    manifest = _read_manifest(path)
+    if manifest is None or manifest["keys"] != keys:
+        return None
+    frame = np.load(os.path.join(path, "frame.npy"), mmap_mode="r")
+    return frame, manifest
+
+# write the shared [terms x samples] train state matrix.  Rows of terms the
+# current matrix already has are copied from it, compute(states, rows) fills
+# in the others (the train_states[row] term of each row.)  Written into a
+# memory mapped file next to states.npy and moved into place when complete:
+# an earlier TrainData may still have the old matrix mapped (rewriting it in
+# place would change or truncate the pages under it.)
+def save_states(path, manifest, train_states, compute, dtype=np.float64):
+    tmp_file = os.path.join(path, "states.npy.tmp%d" % os.getpid())
+    states = np.lib.format.open_memmap(tmp_file, mode="w+",
+                                       dtype=dtype, shape=(len(train_states), manifest["samples"]))
+    old_states = manifest["states"]
+    old = None
+    if old_states is not None:
+        old = np.load(os.path.join(path, "states.npy"), mmap_mode="r")
+    rows = []
+    for j, name in enumerate(train_states):
+        if old_states is not None and name in old_states:
+            states[j] = old[old_states.index(name)]
+        else:
+            rows.append(j)
+    del old
+    if len(rows):
+        compute(states, rows)
+    states.flush()
+    del states
+    os.replace(tmp_file, os.path.join(path, "states.npy"))
+    manifest["states"] = list(train_states)
+    _write_manifest(path, manifest)
+
+# memory map the train state matrix if it was built for exactly these train
+# states, otherwise returns None
+def load_states(path, manifest, train_states):
+    if manifest.get("states") != list(train_states):
+        return None
+    return np.load(os.path.join(path, "states.npy"), mmap_mode=mmap_mode)
@@ -5,15 +5,26 @@
 from math import atan2, cos, sin, sqrt
 import numpy as np
 
-from lib.constants import gravity, d2r, r2d
+from lib.constants import gravity
 from lib import quaternion
+from lib.history import History
+from lib.terms import TermProgram
 
-num = 4 # length of history to maintain in state mgr
+num = 4 # length of history to maintain in state mgr (default)
+max_history = 9 # deepest _n term supported by the state names
+
+# state fields that keep a history list
+history_fields = [ "throttle", "aileron", "elevator", "rudder", "alpha", "beta", "gyros", "accels" ]
 
 class StateManager():
-    def __init__(self, vehicle="wing"):
+    # history: number of past values kept for the history fields (p_1 ..
+    # p_<history>), up to max_history
+    def __init__(self, vehicle="wing", history=num):
+        if history < 1 or history > max_history:
+            raise Exception("history depth must be 1 to %d:" % max_history, history)
         # config
         self.vehicle = vehicle
+        self.history = history
         self.input_states = []
         self.internal_states = []
         self.output_states = []
@@ -30,25 +41,28 @@ class StateManager():
         self.wing_area = 1  # wing area = 1 wing!  "S"
 
         # inputs
-        self.aileron = [0]*num  # list maintains some past state
-        self.elevator = [0]*num  # list maintains some past state
-        self.rudder = [0]*num  # list maintains some past state
+        depth = history + 1
+        self.aileron = History(depth)  # maintains some past state
+        self.elevator = History(depth)  # maintains some past state
+        self.rudder = History(depth)  # maintains some past state
         self.flaps = 0
-        self.throttle = [0]*num  # list maintains some past state
+        self.throttle = History(depth)  # maintains some past state
+        self.motors = [ 0.0, 0.0, 0.0, 0.0 ]  # quad motor outputs
 
         # direct states
         self.time = 0
-        self.gyros = [np.zeros(3)]*num  # list maintains some past state
-        self.accels = [np.zeros(3)]*num  # list maintains some past state
+        self.gyros = History(depth, (3,))  # maintains some past state
+        self.accels = History(depth, (3,))  # maintains some past state
         self.vc_mps = 0       # calibrated airspeed
-        self.alpha = [0]*num  # list maintains some past state
-        self.beta = [0]*num   # list maintains some past state
+        self.alpha = History(depth)  # maintains some past state
+        self.beta = History(depth)   # maintains some past state
         self.vel_ned = np.array( [0.0, 0.0, 0.0] )
         self.gs_mps = 0
         self.phi_rad = 0
         self.the_rad = 0
         self.psi_rad = 0
         self.ned2body = quaternion.eul2quat( 0, 0, 0 )
+        self.rot_body = np.zeros(4)   # attitude integration step
         self.lon = 0
         self.lat = 0
         self.alt = 0
@@ -57,6 +71,7 @@ class StateManager():
         self.qbar = 0
         self.alpha_dot_term2 = 0
         self.alpha_dot_term3 = 0
+        self.q_term1 = 0
 
         self.Cl_raw = 0   # raw/immediate estimate from accels and qbar
         self.thrust = 0
@@ -68,11 +83,22 @@ class StateManager():
         self.g_body = np.array( [0.0, 0.0, 0.0] )
         self.vel_body = np.array( [0.0, 0.0, 0.0] )
 
+        # compiled state lists (see compile_state_list())
+        self.plans = {}
+
+    # the compiled plans are cheap to rebuild, leave them out when the state
+    # manager is sent to another process (process pools)
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["plans"] = {}
+        return state
+
     def set_state_names(self, input_states, internal_states, output_states):
         self.input_states = input_states
         self.internal_states = internal_states
         self.output_states = output_states
         self.state_list = self.input_states + self.internal_states + self.output_states
+        self.compile_state_list(self.state_list)
 
     def get_state_index(self, state_name_list):
         result = []
@@ -102,7 +128,7 @@ class StateManager():
     def set_throttle(self, throttle):
         if throttle < 0: throttle = 0
         if throttle > 1: throttle = 1
-        self.throttle = [throttle] + self.throttle[:num]
+        self.throttle.push(throttle)
         # max thrust is 0.75 gravity, so we can't quite hover on full power
         self.thrust = sqrt(self.throttle[0]) * 0.75 * abs(gravity)
 
@@ -116,9 +142,9 @@ class StateManager():
         if flaps < 0: flaps = 0
         if flaps > 1: flaps = 1
 
-        self.aileron = [aileron] + self.aileron[:num]
-        self.elevator = [elevator] + self.elevator[:num]
-        self.rudder = [rudder] + self.rudder[:num]
+        self.aileron.push(aileron)
+        self.elevator.push(elevator)
+        self.rudder.push(rudder)
         self.flaps = flaps
 
     def set_motors(self, motors):
@@ -129,11 +155,11 @@ class StateManager():
         self.vel_body[0] = vc_mps
         if alpha_rad is not None:
             self.have_alpha = True
-            self.alpha = [alpha_rad] + self.alpha[:num]
+            self.alpha.push(alpha_rad)
             self.alpha_dot = (self.alpha[0] - self.alpha[1]) / self.dt
             self.vel_body[2] = vc_mps * sin(alpha_rad)
         if beta_rad is not None:
-            self.beta = [beta_rad] + self.beta[:num]
+            self.beta.push(beta_rad)
             self.vel_body[1] = vc_mps * sin(beta_rad)
         # print("rudder:", self.rudder, "beta:", self.beta, "vby:", self.vel_body[1])
         # print("alpha:", self.alpha*r2d, "v_body:", self.vel_body)
@@ -143,24 +169,26 @@ class StateManager():
         self.we_filt = 0.95 * self.we_filt + 0.05 * we
 
     def set_gyros(self, gyros):
-        self.gyros = [gyros] + self.gyros[:num]
+        self.gyros.push(gyros)
 
     def set_accels(self, accels):
-        self.accels = [accels] + self.accels[:num]
+        self.accels.push(accels)
 
     def set_ned_velocity(self, vn, ve, vd, wn, we, wd):
         # store NED velocity, corrected to remove wind effects
         self.wn_filt = 0.95 * self.wn_filt + 0.05 * wn
         self.we_filt = 0.95 * self.we_filt + 0.05 * we
         self.wd_filt = 0.95 * self.wd_filt + 0.05 * wd
-        self.vel_ned = np.array( [vn + wn, ve + we, vd + wd] )
+        self.vel_ned[0] = vn + wn
+        self.vel_ned[1] = ve + we
+        self.vel_ned[2] = vd + wd
         self.gs_mps = sqrt( self.vel_ned[0]**2 + self.vel_ned[1]**2 )
 
     def set_orientation(self, phi_rad, the_rad, psi_rad):
         self.phi_rad = phi_rad
         self.the_rad = the_rad
         self.psi_rad = psi_rad
-        self.ned2body = quaternion.eul2quat( phi_rad, the_rad, psi_rad )
+        quaternion.eul2quat( phi_rad, the_rad, psi_rad, out=self.ned2body )
 
     def set_pos(self, lon, lat, alt):
         self.lon = lon
@@ -171,34 +199,36 @@ class StateManager():
 
     # for simulator
     def set_body_velocity(self, v_body):
-        self.vel_body = v_body
+        self.vel_body[:] = v_body
 
     # update attitude
     def update_attitude(self):
         # attitude: integrate rotational rates
-        delta_rot = self.gyros * self.dt
-        rot_body = quaternion.eul2quat(delta_rot[0], delta_rot[1], delta_rot[2])
-        self.ned2body = quaternion.multiply(self.ned2body, rot_body)
+        dt = self.dt
+        quaternion.eul2quat(self.gyros.item(0, 0) * dt, self.gyros.item(0, 1) * dt,
+                            self.gyros.item(0, 2) * dt, out=self.rot_body)
+        quaternion.multiply(self.ned2body, self.rot_body, out=self.ned2body)
         self.phi_rad, self.the_rad, self.psi_rad = quaternion.quat2eul(self.ned2body)
 
     # compute gravity vector in body frame
     def update_gravity_body(self):
-        self.g_body = quaternion.transform(self.ned2body, self.g_ned)
+        quaternion.transform(self.ned2body, self.g_ned, out=self.g_body)
 
     # accels = (ax, ay, az), g_body = (gx, gy, gz)
     def update_body_velocity(self):
-        self.vel_body += (self.accels - self.g_body) * self.dt
-        print(self.g_ned, self.g_body, self.accels - self.g_body, self.vel_body)
+        for i in range(3):
+            self.vel_body[i] += (self.accels.item(0, i) - self.g_body.item(i)) * self.dt
+        # print(self.g_ned, self.g_body, self.accels[0] - self.g_body, self.vel_body)
 
     def update_airdata(self, alpha_rad, beta_rad):
         # self.accels[0] = ax_mps2
-        self.vel_body[0] += (self.accels[0] - self.g_body[0])  * self.dt
+        self.vel_body[0] += (self.accels.item(0, 0) - self.g_body.item(0)) * self.dt
         self.vc_mps = self.vel_body[0]
         self.compute_qbar()
-        self.alpha = [alpha_rad] + self.alpha[:num]
-        self.alpha_dot = (self.alpha - self.alpha_prev1) / self.dt
+        self.alpha.push(alpha_rad)
+        self.alpha_dot = (self.alpha[0] - self.alpha[1]) / self.dt
         self.vel_body[2] = self.vel_body[0] * sin(alpha_rad)
-        self.beta = [beta_rad] + self.beta[:num]
+        self.beta.push(beta_rad)
         self.vel_body[1] = self.vel_body[0] * sin(beta_rad)
 
         # hey, estimate ay, az accels! (and make the new vel official) and FIXME!
@@ -223,12 +253,12 @@ class StateManager():
 
         # alpha and beta from body frame velocity
         # max = 20 * d2r
-        self.alpha = [ atan2( self.vel_body[2], self.vel_body[0] ) ] + self.alpha[:num]
+        self.alpha.push( atan2( self.vel_body[2], self.vel_body[0] ) )
         # if abs(self.alpha) > max:
         #     self.alpha = np.sign(self.alpha) * max
         if len(self.alpha) >= 2:
             self.alpha_dot = (self.alpha[0] - self.alpha[1]) / self.dt
-        self.beta = [ atan2( self.vel_body[1], self.vel_body[0] ) ] + self.beta[:num]
+        self.beta.push( atan2( self.vel_body[1], self.vel_body[0] ) )
         # if abs(self.beta) > max:
         #     self.beta = np.sign(self.beta) * max
 
@@ -250,6 +280,13 @@ class StateManager():
                 self.flying = False
         return self.flying
 
+    # start the history fields over from their current values (at take off,
+    # so the _n terms of a new segment of flight don't reach back to the
+    # ground or to the previous flight)
+    def reset_history(self):
+        for name in history_fields:
+            getattr(self, name).reset()
+
     # compute body frame of reference values
     def compute_derived_states(self, have_alpha_beta=False):
         if self.dt is None:
@@ -258,18 +295,18 @@ class StateManager():
 
         if not have_alpha_beta:
             # rotate ned velocity vector into body frame
-            self.vel_body = quaternion.transform(self.ned2body, self.vel_ned)
+            quaternion.transform(self.ned2body, self.vel_ned, out=self.vel_body)
             #print("v_ned:", self.vel_ned, np.linalg.norm(self.vel_ned),
             #      "v_body:", self.vel_body, np.linalg.norm(self.vel_body))
 
-            # compute alpha and beta estimates) from body frame velocity
-            self.alpha = [ atan2( self.vel_body[2], self.vel_body[0] ) ] + self.alpha[:num]
-            self.beta = [ atan2( -self.vel_body[1], self.vel_body[0] ) ] + self.beta[:num]
+            # compute alpha and beta estimates from body frame velocity
+            self.alpha.push( atan2( self.vel_body[2], self.vel_body[0] ) )
+            self.beta.push( atan2( -self.vel_body[1], self.vel_body[0] ) )
             #print("v(body):", v_body, "alpha = %.1f" % (self.alpha/d2r), "beta = %.1f" % (self.beta/d2r))
 
 
         # rotate ned gravity vector into body frame
-        self.g_body = quaternion.transform(self.ned2body, self.g_ned)
+        quaternion.transform(self.ned2body, self.g_ned, out=self.g_body)
 
         # tmpx = -sin(self.the_rad) * gravity
         # print("g_body x:", self.g_body[0], "sin:", tmpx)
@@ -278,6 +315,10 @@ class StateManager():
         # tmpz = cos(self.phi_rad) * cos(self.the_rad) * gravity
         # print("g_body z:", self.g_body[2], "cos*cos:", tmpz)
 
+    # qbar = 1/2 * V^2 * rho
+    def compute_qbar(self):
+        self.qbar = 0.5 * self.vc_mps**2 * self.rho
+
     # terms are direct combinations of measurable states
     def compute_terms(self):
         # qbar = 1/2 * V^2 * rho
@@ -301,198 +342,154 @@ class StateManager():
         # q_term1: account for pitch bias in turns
         self.q_term1 = sin(self.phi_rad) * (sin(self.phi_rad) / cos(self.phi_rad)) / self.vc_mps
 
-    def gen_state_vector(self, state_list=None, params=None):
-        result = []
+    # compute_derived_states() for whole arrays of samples (time is the last
+    # axis): attitude angles [N] and the ned velocity [3 x N].  Returns a dict
+    # with the ned2body direction cosine matrices [N x 3 x 3], g_body [3 x N]
+    # and, unless alpha and beta are measured, vel_body [3 x N] and the
+    # alpha/beta estimates [N].  Nothing is stored in the state manager.
+    def compute_derived_states_batch(self, phi_rad, the_rad, psi_rad, vel_ned, have_alpha_beta=False):
+        result = {}
+        result["ned2body"] = quaternion.eul2dcm_batch(phi_rad, the_rad, psi_rad)
+        if not have_alpha_beta:
+            # rotate ned velocity vector into body frame
+            vel_body = quaternion.dcm_transform_batch(result["ned2body"], vel_ned.T).T
+            result["vel_body"] = vel_body
+
+            # compute alpha and beta estimates from body frame velocity
+            result["alpha"] = np.arctan2(vel_body[2], vel_body[0])
+            result["beta"] = np.arctan2(-vel_body[1], vel_body[0])
+
+        # rotate ned gravity vector into body frame
+        result["g_body"] = quaternion.dcm_transform_batch(result["ned2body"], self.g_ned).T
+        return result
+
+    # compute_terms() for whole arrays of samples: airspeed, current accels
+    # [3 x N], current alpha and beta, roll and pitch angles.  Returns a dict
+    # of the terms (qbar, Cl_raw, alpha_dot_term2, alpha_dot_term3, q_term1)
+    def compute_terms_batch(self, vc_mps, accels, alpha, beta, phi_rad, the_rad):
+        result = {}
+        qbar = 0.5 * vc_mps**2 * self.rho
+        result["qbar"] = qbar
+        with np.errstate(divide="ignore", invalid="ignore"):
+            lift = -accels[2] * self.mass_kg
+            result["Cl_raw"] = np.where(qbar > 10, lift / (qbar * self.wing_area), 0)
+            cos_beta = np.cos(beta)
+            result["alpha_dot_term2"] = (qbar * self.wing_area) / (self.mass_kg * vc_mps * cos_beta)
+            result["alpha_dot_term3"] = gravity * (np.cos(alpha) * np.cos(phi_rad) * np.cos(the_rad) + np.sin(alpha) * np.sin(the_rad)) / (vc_mps * cos_beta)
+            result["q_term1"] = np.sin(phi_rad) * (np.sin(phi_rad) / np.cos(phi_rad)) / vc_mps
+        return result
+
+    # Compile a list of state names into a term program (see lib/terms.py)
+    # so the names are parsed once instead of on every sample.  Unknown names
+    # and history terms deeper than self.history are rejected here rather
+    # than in the middle of a flight.
+    def compile_state_list(self, state_list):
+        key = (self.history,) + tuple(state_list)
+        if key not in self.plans:
+            self.plans[key] = TermProgram(state_list, self.history)
+        return self.plans[key]
+
+    # out: optional preallocated buffer (array of len(state_list)) to write
+    # the state vector into.  For real time stepping: with out, the
+    # compiled plan and the in place state updates (push(), set_*(),
+    # compute_derived_states(), update_*()) don't create lists or arrays per
+    # step, the terms are evaluated in the plan's scratch array and copied
+    # into out (each scalar operation still makes a transient float.)
+    def gen_state_vector(self, state_list=None, params=None, out=None):
         if state_list is None:
             state_list = self.state_list
-        for index, name in enumerate(state_list):
-            if len(name) >= 3 and name[-2] == "_":
-                field = name[:-2]
-                n = int(name[-1])
-            else:
-                field = name
-                n = 0
-            # Inceptors
-            if field == "throttle":
-                val = self.throttle[n]
-            elif field == "throttle/vc_mps":
-                val = self.throttle[n] / self.vc_mps
-            elif field == "throttle/qbar":
-                val = self.throttle[n] / self.qbar
-            elif field == "throttle*qbar":
-                val = self.throttle[n] * self.qbar
-            elif field == "aileron":
-                val = self.aileron[n]
-            elif field == "elevator":
-                val = self.elevator[n]
-            elif field == "rudder":
-                val = self.rudder[n]
-            elif field == "flaps":
-                val = self.flaps
-            elif field == "aileron*vc_mps":
-                val = self.aileron[n] * self.vc_mps
-            elif field == "aileron*qbar":
-                val = self.aileron[n] * self.qbar
-            elif field == "abs(aileron)*qbar":
-                val = abs(self.aileron[n]) * self.qbar
-            elif field == "elevator*vc_mps":
-                val = self.elevator[n] * self.vc_mps
-            elif field == "elevator*qbar":
-                val = self.elevator[n] * self.qbar
-            elif field == "abs(elevator)*qbar":
-                val = abs(self.elevator[n]) * self.qbar
-            elif field == "rudder*vc_mps":
-                val = self.rudder[n] * self.vc_mps
-            elif field == "rudder*qbar":
-                val = self.rudder[n] * self.qbar
-            elif field == "abs(rudder)*qbar":
-                val = abs(self.rudder[n]) * self.qbar
-            elif field == "flaps*qbar":
-                val = self.flaps * self.qbar
-            elif field == "motor[0]":
-                val = self.motors[0]
-            elif field == "motor[1]":
-                val = self.motors[1]
-            elif field == "motor[2]":
-                val = self.motors[2]
-            elif field == "motor[3]":
-                val = self.motors[3]
-            elif field == "motor[4]":
-                val = self.motors[4]
-            elif field == "motor[5]":
-                val = self.motors[5]
-            elif field == "thrust":
-                val = self.thrust
-            elif field == "bgx":
-                val = self.g_body[0]
-            elif field == "bgy":
-                val = self.g_body[1]
-            elif field == "abs(bgy)":
-                val = abs(self.g_body[1])
-            elif field == "abs(bgy)":
-                val = abs(self.g_body[1])
-            elif field == "bgz":
-                val = self.g_body[2]
-            elif field == "bax":
-                val = self.a_body[0]
-            elif field == "bay":
-                val = self.a_body[1]
-            elif field == "abs(bay)":
-                val = abs(self.a_body[1])
-            elif field == "baz":
-                val = self.a_body[2]
-            elif field == "vc_mps":
-                val = self.vc_mps
-            elif field == "1/vc_mps":
-                if self.vc_mps != 0:
-                    val = 1 / self.vc_mps
-                else:
-                    val = 0
-            elif field == "qbar":
-                val = self.qbar
-            elif field == "1/qbar":
-                if self.qbar != 0:
-                    val = 1 / self.qbar
-                else:
-                    val = 0
-            elif field == "Cl":
-                val = self.Cl_raw
-            elif field == "alpha_deg":
-                val = self.alpha[n] * r2d
-            elif field == "beta_deg":
-                val = self.beta[n] * r2d
-            elif field == "alpha_deg*qbar":
-                val = self.alpha[n] * r2d * self.qbar
-            elif field == "beta_deg*qbar":
-                val = self.beta[n] * r2d * self.qbar
-            elif field == "alpha_deg*vc_mps":
-                val = self.alpha[n] * r2d * self.vc_mps
-            elif field == "beta_deg*vc_mps":
-                val = self.beta[n] * r2d * self.vc_mps
-            elif field == "sin(alpha_deg)*qbar":
-                val = sin(self.alpha[n]) * self.qbar
-            elif field == "alpha_dot":
-                val = self.alpha_dot
-            elif field == "alpha_dot_term2":
-                val = self.alpha_dot_term2
-            elif field == "alpha_dot_term3":
-                val = self.alpha_dot_term3
-            elif field == "sin(beta_deg)*qbar":
-                val = sin(self.beta) * self.qbar
-            elif field == "qbar/cos(beta_deg)":
-                val = self.qbar / cos(self.beta)
-            elif field == "p":
-                val = self.gyros[n][0]
-            elif field == "q":
-                val = self.gyros[n][1]
-            elif field == "q_term1":
-                val = self.q_term1
-            elif field == "r":
-                val = self.gyros[n][2]
-            elif field == "dp":
-                val = (self.gyros[n][0] - self.gyros[n-1][0]) / self.dt
-            elif field == "dq":
-                val = (self.gyros[n][1] - self.gyros[n-1][1]) / self.dt
-            elif field == "dr":
-                val = (self.gyros[n][2] - self.gyros[n-1][2]) / self.dt
-            elif field == "p*qbar":
-                val = self.gyros[n][0]*self.qbar
-            elif field == "q*qbar":
-                val = self.gyros[n][1]*self.qbar
-            elif field == "q/qbar":
-                val = self.gyros[n][1]/self.qbar
-            elif field == "r*qbar":
-                val = self.gyros[n][2]*self.qbar
-            elif field == "p*vc_mps":
-                val = self.gyros[n][0]*self.vc_mps
-            elif field == "q*vc_mps":
-                val = self.gyros[n][1]*self.vc_mps
-            elif field == "r*vc_mps":
-                val = self.gyros[n][2]*self.vc_mps
-            elif field == "ax":
-                val = self.accels[n][0]
-            elif field == "ay":
-                val = self.accels[n][1]
-            elif field == "ay^2":
-                val = self.accels[n][1] * self.accels[n][1]
-            elif field == "ay*vc_mps":
-                val = self.accels[n][1] * self.vc_mps
-            elif field == "ay*qbar":
-                val = self.accels[n][1] * self.qbar
-            elif field == "ay/vc_mps":
-                val = self.accels[n][1] / self.vc_mps
-            elif field == "ay/qbar":
-                val = self.accels[n][1] / self.qbar
-            elif field == "abs(ay)":
-                val = abs(self.accels[n][1])
-            elif field == "az":
-                val = self.accels[n][2]
-            elif field == "az/vc_mps":  # related to q
-                val = self.accels[n][2] / self.vc_mps
-            elif field == "az/qbar":
-                val = self.accels[n][2] / self.qbar
-            elif field == "one":
-                val = 1.0
-            else:
-                raise Exception("Sorry, unknown field name requested:", field)
-            #if True and params is not None and field in self.output_states:
-            if params is not None:
+        program = self.compile_state_list(state_list)
+        result = program.evaluate_state(self, out)
+        #if True and params is not None and field in self.output_states:
+        if params is not None:
+            for index, name in enumerate(program.state_list):
+                val = result[index]
                 param = params[index]
                 t = param["type"]
                 if t == "input" or t == "output":
                     min = param["min"]
                     max = param["max"]
                     std = param["std"]
-                    n = 2
-                    if val < min - n*std:
-                        val = min - n*std
-                        print(field, "clipped to:", val)
-                    if val > max + n*std:
-                        val = max + n*std
-                        print(field, "clipped to:", val)
-            result.append(val)
+                    k = 2
+                    if val < min - k*std:
+                        val = min - k*std
+                        print(name, "clipped to:", val)
+                    if val > max + k*std:
+                        val = max + k*std
+                        print(name, "clipped to:", val)
+                result[index] = val
         return result
 
+    # The raw channel frame: every measured or derived channel that the
+    # train state terms are computed from (see gen_state_matrix()) as a list
+    # of (name, shape) with the sample axis left off.  History channels keep
+    # history+1 entries like the history buffers, dt is the time step the
+    # rate terms are divided by.
+    def frame_layout(self):
+        depth = self.history + 1
+        layout = []
+        for name in [ "throttle", "aileron", "elevator", "rudder", "alpha", "beta" ]:
+            layout.append( (name, (depth,)) )
+        layout.append( ("gyros", (depth, 3)) )
+        layout.append( ("accels", (depth, 3)) )
+        layout.append( ("g_body", (3,)) )
+        if self.vehicle == "quad":
+            layout.append( ("motors", (4,)) )
+        for name in [ "flaps", "thrust", "vc_mps", "alt", "qbar", "Cl_raw", "alpha_dot",
+                      "alpha_dot_term2", "alpha_dot_term3", "q_term1", "dt" ]:
+            layout.append( (name, ()) )
+        return layout
+
+    def frame_width(self):
+        width = 0
+        for name, shape in self.frame_layout():
+            width += int(np.prod(shape))
+        return width
+
+    # the current raw channels as one flat vector (a column of the frame
+    # matrix)
+    def gen_frame_vector(self):
+        result = []
+        for name, shape in self.frame_layout():
+            val = getattr(self, name)
+            if name in history_fields:
+                val = val.values()
+            result.append( np.ravel(val) )
+        return np.concatenate(result)
+
+    # split a [frame_width x samples] matrix into a frame dict of views
+    def unpack_frame(self, matrix):
+        frame = {}
+        row = 0
+        size = matrix.shape[1]
+        for name, shape in self.frame_layout():
+            width = int(np.prod(shape))
+            frame[name] = matrix[row:row+width].reshape(shape + (size,))
+            row += width
+        return frame
+
+    # pack a frame dict into a [frame_width x samples] matrix, channels
+    # missing from the frame hold the current state manager values
+    def pack_frame(self, frame, size, dtype=np.float64):
+        matrix = np.empty( (self.frame_width(), size), dtype=dtype )
+        held = self.unpack_frame( self.gen_frame_vector().reshape(-1, 1) )
+        for name, view in self.unpack_frame(matrix).items():
+            if name in frame:
+                view[...] = frame[name]
+            else:
+                view[...] = held[name]
+        return matrix
+
+    # gen_state_vector() over a whole flight at once.  frame is a dict of
+    # numpy arrays named after the state manager fields, with the last axis
+    # being time.  History fields (throttle, aileron, elevator, rudder, gyros,
+    # accels, alpha, beta) carry the history index as their first axis so
+    # frame["gyros"][n][0] matches self.gyros[n][0].  Returns a [states x
+    # samples] array.  If the frame has a dt channel the rate terms use it
+    # instead of self.dt.
+    def gen_state_matrix(self, state_list, frame):
+        return self.compile_state_list(state_list).evaluate(frame, self.dt)
+
     def state2dict(self, state):
         result = {}
         for i in range(len(state)):
@@ -505,4 +502,3 @@ class StateManager():
         for i in range(len(output_list)):
             result[self.state_list[output_list[i]]] = state[i]
         return result
-
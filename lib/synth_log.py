@@ -0,0 +1,175 @@
+# Synthetic flight logs for testing and benchmarking.
+#
+# Generates a plausible small fixed wing flight (takeoff roll, a flight with
+# random stick inputs through one or more flap settings, landing roll) with
+# simple first order dynamics, so the usual train states correlate the way
+# they do in real data.  Everything is derived from a seed, the same
+# arguments always generate exactly the same log.
+#
+# generate() returns the channels as numpy columns and write_csv() writes
+# them to a csv flight log directory (one <channel>.csv per channel with a
+# header line of field names and a row per record), a layout
+# flight_loader.load() reads, so the benchmark times the real ingestion path
+# from the log on disk.
+
+import os
+
+import numpy as np
+from scipy import signal
+
+from lib.constants import d2r, r2d, gravity
+
+all_channels = [ "imu", "nav", "gps", "airdata", "effectors" ]
+
+# first order lag (time constant tau seconds) of a sampled signal
+def _lag(x, tau, dt):
+    a = np.exp(-dt / tau)
+    return signal.lfilter([1 - a], [1, -a], x)
+
+# band limited random signal with unit-ish amplitude
+def _stick(rng, samples, tau, dt):
+    x = _lag(rng.standard_normal(samples), tau, dt)
+    return x / (np.std(x) + 1e-12)
+
+# indices of the samples of a channel logged at rate_hz (from imu_hz)
+def _decimate(samples, imu_hz, rate_hz):
+    step = max(1, int(round(imu_hz / rate_hz)))
+    return np.arange(0, samples, step)
+
+# samples: number of imu records
+# imu_hz: imu (and nav) rate, the other channels are logged at their own rates
+# noise: scales all the sensor noise (0 for perfect measurements)
+# flaps: flap settings flown, the flight is split evenly between them
+# alpha_beta: include alpha/beta vanes in the airdata channel
+# biases: include imu bias estimates in the nav channel
+# channels: subset of all_channels to include (imu and nav are required)
+def generate(samples, imu_hz=50, air_hz=25, act_hz=50, gps_hz=5, noise=1.0,
+             flaps=[0, 0.5], alpha_beta=False, biases=True, channels=None, seed=0):
+    rng = np.random.default_rng(seed)
+    dt = 1.0 / imu_hz
+    time = np.arange(samples) * dt
+    duration = samples * dt
+    cruise_mps = 18.0
+    if channels is None:
+        channels = all_channels
+
+    # airspeed envelope: takeoff roll, flight, landing roll
+    envelope = np.interp(time, [0, 0.03*duration, 0.05*duration, 0.95*duration, 0.98*duration, duration],
+                         [0, 0, 1, 1, 0, 0])
+    airborne = np.clip(envelope * 4 - 2, 0, 1)
+
+    # inputs
+    aileron = np.clip(0.25 * _stick(rng, samples, 0.5, dt), -1, 1)
+    elevator = np.clip(-0.05 + 0.15 * _stick(rng, samples, 0.7, dt), -1, 1)
+    rudder = np.clip(0.15 * _stick(rng, samples, 1.0, dt), -1, 1)
+    throttle = np.clip(0.55 + 0.2 * _stick(rng, samples, 3.0, dt), 0, 1) * (envelope > 0)
+    flap_index = np.minimum((time / duration * len(flaps)).astype(int), len(flaps) - 1)
+    flap_pos = np.array(flaps, dtype=float)[flap_index]
+
+    # airspeed (and dynamic pressure ratio)
+    vc = envelope * (cruise_mps + _lag(6 * (throttle - 0.55) - 4 * flap_pos, 2.0, dt))
+    vc = np.maximum(vc, 0)
+    qratio = (vc / cruise_mps)**2
+
+    # rotational rates respond to the control surfaces with qbar
+    p = _lag(3.0 * aileron * qratio, 0.3, dt) * airborne
+    q = _lag(-2.0 * (elevator + 0.05) * qratio, 0.2, dt) * airborne
+    beta = _lag(-0.1 * rudder * qratio, 0.5, dt) * airborne
+
+    # attitude (leaky integrals keep the random walk near level flight)
+    phi = signal.lfilter([dt], [1, -0.999], p)
+    the = signal.lfilter([dt], [1, -0.999], q) + 0.05 * airborne
+    r = (_lag(1.0 * rudder * qratio, 0.5, dt) + gravity / np.maximum(vc, 5) * np.sin(phi)) * airborne
+    psi = np.cumsum(r) * dt + rng.uniform(0, 2*np.pi)
+    alpha = (0.06 + _lag(-0.3 * elevator, 0.3, dt)) * airborne
+
+    # body frame specific forces
+    vc_dot = np.gradient(vc, dt)
+    ax = vc_dot + gravity * np.sin(the)
+    ay = -gravity * np.cos(the) * np.sin(phi) * (1 - airborne) - 3.0 * beta * qratio
+    az = -gravity * np.cos(phi) * np.cos(the) - vc * q
+
+    # ned velocity and position
+    gamma = the - alpha
+    vn = vc * np.cos(gamma) * np.cos(psi)
+    ve = vc * np.cos(gamma) * np.sin(psi)
+    vd = -vc * np.sin(gamma)
+    alt = 300 + np.cumsum(-vd) * dt
+    lat = 45.0 + np.cumsum(vn) * dt / 111320
+    lon = -93.0 + np.cumsum(ve) * dt / (111320 * np.cos(45 * d2r))
+
+    def noisy(x, std):
+        return x + rng.standard_normal(len(x)) * std * noise
+
+    data = {}
+    gyro_bias = np.array([0.01, -0.005, 0.002])
+    accel_bias = np.array([0.05, -0.02, 0.1])
+    data["imu"] = {
+        "timestamp": time,
+        "p_rps": noisy(p + gyro_bias[0], 0.01),
+        "q_rps": noisy(q + gyro_bias[1], 0.01),
+        "r_rps": noisy(r + gyro_bias[2], 0.01),
+        "ax_mps2": noisy(ax + accel_bias[0], 0.1),
+        "ay_mps2": noisy(ay + accel_bias[1], 0.1),
+        "az_mps2": noisy(az + accel_bias[2], 0.1),
+    }
+    data["nav"] = {
+        "timestamp": time,
+        "phi_deg": noisy(phi * r2d, 0.1),
+        "theta_deg": noisy(the * r2d, 0.1),
+        "psi_deg": noisy((psi * r2d) % 360, 0.2),
+        "latitude_deg": lat,
+        "longitude_deg": lon,
+        "altitude_m": noisy(alt, 0.5),
+        "vn_mps": noisy(vn, 0.1),
+        "ve_mps": noisy(ve, 0.1),
+        "vd_mps": noisy(vd, 0.1),
+    }
+    if biases:
+        for j, axis in enumerate(["p", "q", "r"]):
+            data["nav"][axis + "_bias"] = np.full(samples, gyro_bias[j])
+        for j, axis in enumerate(["ax", "ay", "az"]):
+            data["nav"][axis + "_bias"] = np.full(samples, accel_bias[j])
+    if "gps" in channels:
+        idx = _decimate(samples, imu_hz, gps_hz)
+        data["gps"] = {
+            "timestamp": time[idx],
+            "latitude_deg": lat[idx],
+            "longitude_deg": lon[idx],
+            "altitude_m": noisy(alt[idx], 2.0),
+            "vn_mps": noisy(vn[idx], 0.2),
+            "ve_mps": noisy(ve[idx], 0.2),
+            "vd_mps": noisy(vd[idx], 0.2),
+        }
+    else:
+        data["gps"] = { "timestamp": np.zeros(0) }
+    if "airdata" in channels:
+        idx = _decimate(samples, imu_hz, air_hz)
+        data["airdata"] = {
+            "timestamp": time[idx],
+            "airspeed_mps": np.maximum(noisy(vc[idx], 0.3), 0),
+        }
+        if alpha_beta:
+            data["airdata"]["alpha"] = noisy(alpha[idx] * r2d, 0.2)
+            data["airdata"]["beta"] = noisy(beta[idx] * r2d, 0.2)
+    if "effectors" in channels:
+        idx = _decimate(samples, imu_hz, act_hz)
+        data["effectors"] = {
+            "timestamp": time[idx],
+            "throttle": throttle[idx],
+            "aileron": aileron[idx],
+            "elevator": elevator[idx],
+            "rudder": rudder[idx],
+            "flaps": flap_pos[idx],
+        }
+    return data
+
+# write generated columns as a csv flight log directory, a whole channel at
+# a time
+def write_csv(data, path):
+    os.makedirs(path, exist_ok=True)
+    for channel, columns in data.items():
+        fields = list(columns.keys())
+        table = np.column_stack( [ columns[field] for field in fields ] )
+        np.savetxt(os.path.join(path, channel + ".csv"), table, fmt="%.12g",
+                   delimiter=",", header=",".join(fields), comments="")
@@ -46,6 +46,8 @@ import dask.array as da         # dnf install python3-dask+array / pip install d
 from matplotlib import pyplot as plt
 import numpy as np
 
+from lib import gram
+from lib import perf
 from lib.state_mgr import StateManager
 
 class SystemIdentification():
@@ -198,13 +200,35 @@ class SystemIdentification():
                 incl[idx[0][0]] = True
             print("")
 
-    def solve(self, traindata, includes_idx, solutions_idx):
-        srcdata = traindata[includes_idx,:]
-        soldata = traindata[solutions_idx,:]
-        states = len(traindata[0])
-
-        self.X = np.array(srcdata[:,:-1])
-        self.Y = np.array(soldata[:,1:])
+    # method: "svd" (dask svd of the whole X) or "cholesky" / "pinv" to sum
+    # the Gram matrices a chunk at a time and solve those (see lib/gram.py.)
+    # "ridge" and "tsvd" are regularized Gram solves over a grid of lambdas
+    # (gram.regularized), the lambda of each output is picked by select:
+    # "gcv" or "holdout" (the error on the last holdout fraction of the
+    # samples when fitted to the rest.)
+    # stats: solve from these Gram matrices instead (the running statistics
+    # of earlier flights with this one appended), implies "cholesky" for
+    # method="svd"
+    # columns: traindata is the (memory mapped) session states and columns
+    # selects the samples of the condition (see gram.pair_index()), the Gram
+    # solves stream them from the session without a copy of the condition.
+    # segments: samples are only paired with the next one in the same
+    # segment of flight (TrainData.segments)
+    def solve(self, traindata, includes_idx, solutions_idx, method="svd", names=None, stats=None,
+              lambdas=None, select="gcv", holdout=0.2, columns=None, segments=None):
+        if stats is not None and method == "svd":
+            method = "cholesky"
+        self.x_idx, self.y_idx = gram.pair_index(traindata.shape[1], columns, segments)
+        if method != "svd":
+            self.solve_gram(traindata, includes_idx, solutions_idx, method, names, stats, lambdas, select, holdout, columns, segments)
+            return
+
+        # traindata may be memory mapped, only the included/solution rows are
+        # read (fancy indexing already makes in memory copies of those rows)
+        states = len(self.x_idx) + 1
+
+        self.X = gram.take(traindata, includes_idx, self.x_idx)
+        self.Y = gram.take(traindata, solutions_idx, self.y_idx)
         print("X:", self.X.shape)
         print("Y:", self.Y.shape)
         # print("X:\n", np.array(X))
@@ -244,12 +268,79 @@ class SystemIdentification():
         print("A rank:", np.linalg.matrix_rank(self.A))
         print("A:\n", self.A.shape, self.A)
 
+    def solve_gram(self, traindata, includes_idx, solutions_idx, method="cholesky", names=None, stats=None,
+                   lambdas=None, select="gcv", holdout=0.2, columns=None, segments=None):
+        if stats is None:
+            with perf.timer.stage("gram", records=len(self.x_idx)):
+                stats = gram.accumulate(traindata, includes_idx, solutions_idx, columns, segments=segments)
+        self.gram = stats
+        self.gram.report(names)
+        if method in gram.regularized:
+            self.A = self.solve_regularized(traindata, includes_idx, solutions_idx, method, names, lambdas, select, holdout, columns, segments)
+        else:
+            self.A = self.gram.solve(method)
+        # ranges() and model_noise() read the X and Y rows of the sample
+        # pairs from the train data as they need them
+        self.X = None
+        self.Y = None
+        self.traindata = traindata
+        self.includes_idx = includes_idx
+        self.solutions_idx = solutions_idx
+        print("X:", (len(includes_idx), len(self.x_idx)))
+        print("Y:", (len(solutions_idx), len(self.y_idx)))
+        print("A rank:", np.linalg.matrix_rank(self.A))
+        print("A:\n", self.A.shape, self.A)
+
+    # A from saved Gram matrices alone (a refreshed model condition without
+    # new samples), holdout selection falls back to gcv without train data
+    def solve_stats(self, stats, solutions_idx, method="cholesky", names=None, lambdas=None, select="gcv"):
+        self.gram = stats
+        self.gram.report(names)
+        if method in gram.regularized:
+            self.A = self.solve_regularized(None, None, solutions_idx, method, names, lambdas, select, None)
+        else:
+            self.A = self.gram.solve(method)
+        print("A rank:", np.linalg.matrix_rank(self.A))
+        print("A:\n", self.A.shape, self.A)
+
+    def solve_regularized(self, traindata, includes_idx, solutions_idx, method, names, lambdas, select, holdout, columns=None, segments=None):
+        if lambdas is None:
+            lambdas = gram.regularized[method]
+        outputs = [ names[i] for i in solutions_idx ] if names is not None else None
+        path = self.gram.path(lambdas, method)
+        if select == "holdout" and self.gram.forget < 1:
+            print("holdout selection needs forget = 1, using gcv")
+            select = "gcv"
+        if select == "holdout" and traindata is None:
+            print("holdout selection needs the train data, using gcv")
+            select = "gcv"
+        if select == "holdout":
+            # fit to all but the last samples, score on those (the Gram of
+            # the rest is the total minus the holdout slice)
+            if columns is None:
+                columns = np.arange(traindata.shape[1])
+            split = int(len(columns) * (1 - holdout))
+            hold = gram.accumulate(traindata, includes_idx, solutions_idx, columns[split:], segments=segments)
+            train_path = self.gram.remove(hold).path(lambdas, method)
+            score = np.array( [ hold.error(A) for A in train_path["A"] ] ) / max(hold.samples, 1)
+        elif select == "gcv":
+            score = self.gram.gcv(path)
+        else:
+            raise Exception("unknown lambda selection:", select)
+        print("%s lambda selection (%s):" % (method, select))
+        A, best = gram.choose(path, score, outputs)
+        self.selection = { "method": method, "select": select, "lambda": path["lambdas"][best].tolist() }
+        return A
+
     def ranges(self, train_states):
         # compute expected ranges for output parameters
         self.parameters = []
         for i in range(len(train_states)):
             print("i:", i, train_states[i])
-            row = self.X[i,:]
+            if self.X is not None:
+                row = self.X[i,:]
+            else:
+                row = self.traindata[self.includes_idx[i], self.x_idx]
             min = np.min(row)
             max = np.max(row)
             mean = np.mean(row)
@@ -362,13 +453,17 @@ class SystemIdentification():
         # turbulence, or artifacts in the data log (like a 5hz gps update rate
         # showing up in ekf velocity estimate.)
 
-        pred = []
-        for i in range(len(self.X.T)):
-            v  = traindata[:,i].copy()
-            p = self.A @ np.array(v)
-            pred.append(p)
-        Ypred = np.array(pred).T
-        diff = Ypred - self.Y
+        if self.X is not None:
+            diff = self.A @ self.X - self.Y
+        else:
+            # a chunk of sample pairs at a time
+            chunk = 1 << 16
+            diff = []
+            for start in range(0, len(self.x_idx), chunk):
+                X = gram.take(traindata, self.includes_idx, self.x_idx[start:start+chunk])
+                Y = gram.take(traindata, self.solutions_idx, self.y_idx[start:start+chunk])
+                diff.append(self.A @ X - Y)
+            diff = np.hstack(diff)
 
         M=1024
         from scipy import signal
@@ -455,10 +550,16 @@ class SystemIdentification():
             print(params[output_idx[i]]["contributors"])
             print(params[output_idx[i]]["formula"])
 
-    def simulate(self, traindata, train_states, includes_idx, solutions_idx):
+    # plot=False skips the plots (see plot_simulation()), returns the
+    # estimates [solutions x samples].  columns selects the samples of
+    # traindata (see solve())
+    def simulate(self, traindata, train_states, includes_idx, solutions_idx, plot=True, columns=None):
         # make a copy because we are going to roll our state estimates through the
         # data matrix and make a mess (or a piece of artwork!) out of it.
-        data = traindata.copy()
+        if columns is None:
+            data = traindata.copy()
+        else:
+            data = traindata[:,columns]     # (fancy indexing copies)
         print("simulate:", data.shape, includes_idx, solutions_idx)
 
         # this gets a little funky because we will be using numpy implied indexing below.
@@ -498,7 +599,14 @@ class SystemIdentification():
             est.append(next)
         # return np.array(est).T
         est = np.array(est).T
-
+        if plot:
+            if columns is not None:
+                traindata = traindata[:,columns]
+            self.plot_simulation(traindata, train_states, solutions_idx, est)
+        return est
+
+    # show=False leaves the figures open for one plt.show() later on
+    def plot_simulation(self, traindata, train_states, solutions_idx, est, show=True):
         for j in range(len(solutions_idx)):
             plt.figure()
             plt.plot(traindata[solutions_idx[j],:], label="%s (orig)" % train_states[solutions_idx[j]])
@@ -507,7 +615,8 @@ class SystemIdentification():
             plt.plot(est[j,:], label="%s (pred)" % train_states[solutions_idx[j]])
             # plt.ylim([-20,20])
             plt.legend()
-        plt.show()
+        if show:
+            plt.show()
 
     def save(self, model_name, dt):
         # the median delta t from the data log is important to include
@@ -0,0 +1,398 @@
+# Train state terms as expressions over the raw state channels.
+#
+# A term name is parsed as an expression instead of being looked up in a
+# hand maintained table, so any combination of the channels below can be
+# used as a train state:
+#
+#   "alpha_deg*qbar", "throttle/vc_mps", "abs(rudder)*qbar", "1/qbar",
+#   "qbar/cos(beta_deg)", "ay^2", "p_1", "elevator*qbar_2", "motor[0]"
+#
+# Grammar:
+#
+#   term    := expr [ "_" digit ]
+#   expr    := product { ("+" | "-") product }
+#   product := power { ("*" | "/") power }
+#   power   := unary [ "^" digit ]
+#   unary   := "-" unary | atom
+#   atom    := number | symbol | function "(" expr ")" | "(" expr ")"
+#
+# A trailing _n (1-9) is the history index: it applies to every history
+# channel in the term (throttle, aileron, elevator, rudder, alpha, beta, the
+# gyros and accels) and the other channels use their current value.  n can't
+# be deeper than the history the program is compiled for.  Long
+# standing conventions of the original term table are kept:
+#
+#   * 1/x is 0 where x is 0 (other divisions are plain divisions)
+#   * sin() and cos() take degrees, and sin(alpha_deg) is computed directly as
+#     sin(alpha) in radians
+#   * dp, dq, dr are (p[n] - p[n-1]) / dt and n-1 wraps around to the oldest
+#     history entry for n = 0
+#
+# All the terms of a state list are compiled into one graph (TermProgram)
+# where equal subexpressions are only stored, and computed, once: qbar,
+# alpha in degrees, the gyro and accel channels and so on are shared by
+# every term that uses them.  The program is evaluated either vectorized over
+# a whole frame (see StateManager.frame_layout()) or on the current values
+# of a state manager.
+
+from math import cos, sin
+import numpy as np
+
+from lib.constants import d2r, r2d
+
+# channels that keep a history, (frame channel, component)
+history_symbols = {
+    "throttle": ("throttle", None),
+    "aileron": ("aileron", None),
+    "elevator": ("elevator", None),
+    "rudder": ("rudder", None),
+    "alpha": ("alpha", None),
+    "beta": ("beta", None),
+    "p": ("gyros", 0),
+    "q": ("gyros", 1),
+    "r": ("gyros", 2),
+    "ax": ("accels", 0),
+    "ay": ("accels", 1),
+    "az": ("accels", 2),
+}
+
+# channels without history, (frame channel, component)
+current_symbols = {
+    "flaps": ("flaps", None),
+    "thrust": ("thrust", None),
+    "vc_mps": ("vc_mps", None),
+    "qbar": ("qbar", None),
+    "Cl": ("Cl_raw", None),
+    "alpha_dot": ("alpha_dot", None),
+    "alpha_dot_term2": ("alpha_dot_term2", None),
+    "alpha_dot_term3": ("alpha_dot_term3", None),
+    "q_term1": ("q_term1", None),
+    "bgx": ("g_body", 0),
+    "bgy": ("g_body", 1),
+    "bgz": ("g_body", 2),
+}
+
+# split a term name into its expression and history index ("p_2" -> "p", 2)
+def split_history(name):
+    if len(name) >= 3 and name[-2] == "_" and name[-1].isdigit():
+        return name[:-2], int(name[-1])
+    return name, 0
+
+def _inverse(x):
+    if x != 0:
+        return 1 / x
+    return 0
+
+def _add(a, b):
+    return a + b
+
+def _sub(a, b):
+    return a - b
+
+def _mul(a, b):
+    return a * b
+
+# x/0 is inf or nan like the vectorized version, not an exception
+def _div(a, b):
+    if b == 0:
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return float(np.divide(a, b))
+    return a / b
+
+def _neg(a):
+    return -a
+
+def _inverse_into(x, out):
+    np.divide(1, x, out=out)
+    out[x == 0] = 0
+    return out
+
+# op: (scalar function, vectorized ufunc)
+ops = {
+    "add": (_add, np.add),
+    "sub": (_sub, np.subtract),
+    "mul": (_mul, np.multiply),
+    "div": (_div, np.divide),
+    "neg": (_neg, np.negative),
+    "inv": (_inverse, _inverse_into),
+    "abs": (abs, np.abs),
+    "sin": (sin, np.sin),
+    "cos": (cos, np.cos),
+}
+commutative = [ "add", "mul" ]
+functions = [ "abs", "sin", "cos" ]
+
+def _tokenize(text):
+    tokens = []
+    i = 0
+    while i < len(text):
+        c = text[i]
+        if c.isspace():
+            i += 1
+        elif c.isalpha() or c == "_":
+            j = i
+            while j < len(text) and (text[j].isalnum() or text[j] == "_"):
+                j += 1
+            if text[i:j] == "motor" and j < len(text) and text[j] == "[":
+                # motor[k] is one symbol
+                j = text.index("]", j) + 1
+            tokens.append(text[i:j])
+            i = j
+        elif c.isdigit() or c == ".":
+            j = i
+            while j < len(text) and (text[j].isdigit() or text[j] == "."):
+                j += 1
+            tokens.append(float(text[i:j]))
+            i = j
+        elif c in "+-*/^()":
+            tokens.append(c)
+            i += 1
+        else:
+            raise Exception("Sorry, unknown character in term:", text)
+    return tokens
+
+# The graph of all the terms of a state list.  Nodes are tuples:
+#   ("channel", name, history index, component)
+#   ("const", value)
+#   (op, child node index, ...)
+# stored once each in evaluation order (children before parents.)
+# history: the number of past values kept for the history channels
+# (StateManager.history), terms asking for older values are rejected.
+class TermProgram():
+    def __init__(self, state_list, history):
+        self.state_list = list(state_list)
+        self.history = history
+        self.nodes = []
+        self.index = {}
+        self.outputs = []
+        for name in self.state_list:
+            self.outputs.append( self._parse(name) )
+        # last node that reads each node (intermediate results are released
+        # once they are no longer needed)
+        self.last_use = [ -1 ] * len(self.nodes)
+        for i, node in enumerate(self.nodes):
+            if node[0] in ops:
+                for child in node[1:]:
+                    self.last_use[child] = i
+        self.output_rows = {}
+        for row, i in enumerate(self.outputs):
+            self.output_rows.setdefault(i, []).append(row)
+        # the channels don't depend on anything, fetch them first and then
+        # run the operations in order.  Every node has a slot in the
+        # preallocated scratch array that evaluate_state() reuses, the
+        # constants are filled in once.
+        self.channels = []
+        self.steps = []
+        self.scratch = np.zeros(len(self.nodes))
+        self.output_index = np.array(self.outputs, dtype=int)
+        # (a memoryview reads and writes the slots as plain floats)
+        self.slots = memoryview(self.scratch)
+        for i, node in enumerate(self.nodes):
+            if node[0] in ops:
+                self.steps.append( (i, ops[node[0]][0], node[1:]) )
+            elif node[0] == "channel":
+                self.channels.append( (i,) + node[1:] )
+            else:
+                self.scratch[i] = node[1]
+
+    def _add_node(self, node):
+        if node[0] in commutative:
+            node = (node[0],) + tuple(sorted(node[1:]))
+        if node not in self.index:
+            self.index[node] = len(self.nodes)
+            self.nodes.append(node)
+        return self.index[node]
+
+    # parse one term name into the graph, returns its node index
+    def _parse(self, name):
+        expr, n = split_history(name)
+        self.name = name
+        self.n = n
+        if n > self.history:
+            self._error()
+        self.tokens = _tokenize(expr)
+        self.pos = 0
+        result = self._expr()
+        if self.pos != len(self.tokens):
+            self._error()
+        return result
+
+    def _error(self):
+        raise Exception("Sorry, unknown field name requested:", self.name)
+
+    def _peek(self):
+        if self.pos < len(self.tokens):
+            return self.tokens[self.pos]
+        return None
+
+    def _next(self):
+        token = self._peek()
+        if token is None:
+            self._error()
+        self.pos += 1
+        return token
+
+    def _expect(self, token):
+        if self._next() != token:
+            self._error()
+
+    def _expr(self):
+        result = self._product()
+        while self._peek() in ("+", "-"):
+            op = "add" if self._next() == "+" else "sub"
+            result = self._add_node( (op, result, self._product()) )
+        return result
+
+    def _product(self):
+        result = self._power()
+        while self._peek() in ("*", "/"):
+            if self._next() == "*":
+                result = self._add_node( ("mul", result, self._power()) )
+            else:
+                divisor = self._power()
+                if self.nodes[result] == ("const", 1.0):
+                    result = self._add_node( ("inv", divisor) )
+                else:
+                    result = self._add_node( ("div", result, divisor) )
+        return result
+
+    def _power(self):
+        base = self._unary()
+        if self._peek() == "^":
+            self._next()
+            k = self._next()
+            if not isinstance(k, float) or k != int(k) or k < 1:
+                self._error()
+            # small integer powers as repeated products (ay^2 = ay*ay)
+            result = base
+            for i in range(int(k) - 1):
+                result = self._add_node( ("mul", result, base) )
+            return result
+        return base
+
+    def _unary(self):
+        if self._peek() == "-":
+            self._next()
+            return self._add_node( ("neg", self._unary()) )
+        return self._atom()
+
+    def _atom(self):
+        token = self._next()
+        if isinstance(token, float):
+            return self._add_node( ("const", token) )
+        if token == "(":
+            result = self._expr()
+            self._expect(")")
+            return result
+        if token in functions:
+            self._expect("(")
+            arg = self._expr()
+            self._expect(")")
+            if token in ("sin", "cos"):
+                arg = self._radians(arg)
+            return self._add_node( (token, arg) )
+        return self._symbol(token)
+
+    # trig functions take degrees: x_deg (x * r2d) goes back to x itself
+    # rather than through x * r2d * d2r
+    def _radians(self, arg):
+        node = self.nodes[arg]
+        r2d_node = self.index.get( ("const", r2d) )
+        if node[0] == "mul" and r2d_node in node[1:]:
+            if node[1] == r2d_node:
+                return node[2]
+            return node[1]
+        return self._add_node( ("mul", arg, self._add_node( ("const", d2r) )) )
+
+    def _channel(self, channel, n, component):
+        return self._add_node( ("channel", channel, n, component) )
+
+    def _symbol(self, token):
+        n = self.n
+        if token in history_symbols:
+            channel, component = history_symbols[token]
+            return self._channel(channel, n, component)
+        if token in current_symbols:
+            channel, component = current_symbols[token]
+            return self._channel(channel, None, component)
+        if token in ("alpha_deg", "beta_deg"):
+            angle = self._channel(token[:-4], n, None)
+            return self._add_node( ("mul", angle, self._add_node( ("const", r2d) )) )
+        if token in ("dp", "dq", "dr"):
+            component = "pqr".index(token[1])
+            # n-1 wraps around to the oldest entry like the history lists
+            delta = self._add_node( ("sub", self._channel("gyros", n, component),
+                                     self._channel("gyros", n-1, component)) )
+            return self._add_node( ("div", delta, self._channel("dt", None, None)) )
+        if token == "one":
+            return self._add_node( ("const", 1.0) )
+        if token.startswith("motor[") and token.endswith("]"):
+            return self._channel("motors", None, int(token[6:-1]))
+        self._error()
+
+    # the terms from the current values of a state manager, returns a list.
+    # With out (a preallocated array or list of len(state_list)) the terms
+    # are written into out instead.  The node values live in the scratch
+    # array, so a simulation step doesn't create lists or arrays (only the
+    # transient float of each scalar operation.)
+    def evaluate_state(self, state_mgr, out=None):
+        values = self.slots
+        for i, name, n, component in self.channels:
+            val = getattr(state_mgr, name)
+            if n is not None:
+                values[i] = val.item(n, component)
+            elif component is not None:
+                values[i] = val[component]
+            else:
+                values[i] = val
+        for i, func, children in self.steps:
+            if len(children) == 2:
+                values[i] = func(values[children[0]], values[children[1]])
+            else:
+                values[i] = func(values[children[0]])
+        if out is None:
+            return self.scratch[self.output_index].tolist()
+        if isinstance(out, np.ndarray) and out.dtype == self.scratch.dtype:
+            np.take(self.scratch, self.output_index, out=out, mode="clip")
+        else:
+            for row, i in enumerate(self.outputs):
+                out[row] = values[i]
+        return out
+
+    # the terms over a whole frame (dict of channel arrays with time as the
+    # last axis, history channels with the history index first.)  dt is used
+    # when the frame has no dt channel.  Returns a [terms x samples] array.
+    # Terms are computed straight into their rows of the result.
+    def evaluate(self, frame, dt=None, dtype=np.float64):
+        size = len(frame["vc_mps"])
+        result = np.empty( (len(self.outputs), size), dtype=dtype )
+        values = [ None ] * len(self.nodes)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            for i, node in enumerate(self.nodes):
+                op = node[0]
+                rows = self.output_rows.get(i, [])
+                if op == "channel":
+                    if node[1] == "dt" and "dt" not in frame:
+                        val = dt
+                    else:
+                        val = frame[node[1]]
+                        if node[2] is not None:
+                            val = val[node[2]]
+                        if node[3] is not None:
+                            val = val[node[3]]
+                elif op == "const":
+                    val = node[1]
+                else:
+                    args = [ values[child] for child in node[1:] ]
+                    if rows and dtype == np.float64:
+                        val = ops[op][1]( *args, out=result[rows[0]] )
+                        rows = rows[1:]
+                    else:
+                        val = ops[op][1]( *args, out=np.empty(size) )
+                    for child in node[1:]:
+                        if self.last_use[child] == i:
+                            values[child] = None
+                values[i] = val
+                for row in rows:
+                    result[row] = val
+        return result
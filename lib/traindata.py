@@ -1,262 +1,903 @@
+from concurrent.futures import ProcessPoolExecutor
+import copy
+import hashlib
+import json
 from math import cos, pi, sin
+import multiprocessing
 import numpy as np
 import os
-import hickle  # pip install hickle; # (pickle data into hdf5 format)
 from tqdm import tqdm
 
 from flightdata import flight_loader, flight_interp
 
-from .constants import d2r, r2d, kt2mps
+from .constants import d2r, r2d, kt2mps, gravity
+from .column_buffer import ColumnBuffer
+from . import perf
+from . import session_store
 from .wind import Wind
 
+# The train data of each flight condition.  The conditions share one [train
+# states x samples] matrix and only keep the index of their samples, so
+# overlapping conditions don't duplicate any data.  cond_list[i] returns the
+# [train states x samples] matrix of condition i (a new array, or an empty
+# array if nothing matched), assigning a matrix to cond_list[i] replaces the
+# condition's data with it.  The index list is shared with the caller so
+# editing an index (dropping bad segments, re-binning) shows up here.
+class ConditionList():
+    def __init__(self, states, cond_index):
+        self.states = states
+        self.items = cond_index
+
+    def __len__(self):
+        return len(self.items)
+
+    def __getitem__(self, i):
+        item = self.items[i]
+        if item.ndim == 2:
+            return item
+        if not len(item):
+            return np.array([])
+        return self.states[:,item]
+
+    def __setitem__(self, i, matrix):
+        self.items[i] = np.asarray(matrix)
+
 class TrainData():
     def __init__(self):
-        self.session = None
+        self.cache_dir = "session_cache"
+        # storage type of the train data matrices (np.float32 halves the
+        # memory needed for large sessions)
+        self.dtype = np.float64
+        # samples per slice when computing new train state terms
+        self.term_chunk = 1 << 18
         self.cond_list = []
+        self.cond_index = []
+        self.dt_stats = []
+        # [start, end) sample ranges of each continuous run of flight in the
+        # session, history terms don't carry across them
+        self.segments = np.zeros( (0, 2), dtype=int )
 
-    def load_flightdata(self, file_list, vehicle, invert_elevator, invert_rudder, state_mgr, conditions, train_states):
-        self.session_file = "session_data.hkl"
+    # batch=True computes the raw channels for each whole flight log in
+    # numpy array operations (see parse_batch()) instead of stepping the
+    # state manager through every interpolated record.  Both paths should
+    # produce the same train data.
+    def load_flightdata(self, file_list, vehicle, invert_elevator, invert_rudder, state_mgr, conditions, train_states, batch=False, jobs=None):
+        self.file_list = file_list
+        self.train_states = train_states
+        # bad names or history terms deeper than state_mgr.history fail
+        # here, before any log is parsed
+        state_mgr.compile_state_list(train_states)
 
-        if os.path.exists(self.session_file):
-            print("loading session from cached hickle file:", self.session_file)
-            self.session = hickle.load(self.session_file)
+        # Parsed logs are cached per file, keyed by a hash of the file
+        # contents and every parameter that affects the parse, so adding a
+        # log only parses the new log.  The cache holds the raw channels, the
+        # train states are computed from them afterwards (and remembered) and
+        # the conditions select samples of the train states, so changing
+        # either doesn't reparse anything.
+        # Everything is memory mapped from disk (see session_store.py)
+        os.makedirs(self.cache_dir, exist_ok=True)
+        params = parse_params(vehicle, invert_elevator, invert_rudder, state_mgr)
+        params["dtype"] = np.dtype(self.dtype).name
+        keys = []
+        for file in file_list:
+            keys.append( cache_key(file, params, self.cache_dir) )
+        self.session_dir = os.path.join(self.cache_dir, "session")
 
-            if self.session["file_list"] == file_list and self.session["train_states"] == train_states:
-                self.flight_format = self.session["flight_format"]
-                self.cond_list = self.session["cond_list"]
-                self.train_states = self.session["train_states"]
-                self.file_list = self.session["file_list"]
-                self.dt = self.session["dt"]
-                return "cached"
+        if self.load_session(keys, state_mgr):
+            print("loaded memory mapped session from:", self.session_dir)
+            self.states = self.load_states(state_mgr, train_states)
+            self.set_conditions(conditions)
+            return "cached"
 
-        print("file set or train state changed, so need to rebuild session data ...")
+        entry_paths = []
+        work = []
+        for i, file in enumerate(file_list):
+            entry_path = os.path.join(self.cache_dir, keys[i])
+            entry_paths.append(entry_path)
+            if session_store.load_entry(entry_path) is not None:
+                print("using cached parse of", file, "from:", entry_path)
+            else:
+                work.append( (entry_path, self.dtype, (file, vehicle, invert_elevator, invert_rudder, copy.deepcopy(state_mgr), batch)) )
 
-        self.file_list = file_list
-        self.train_states = train_states
+        # Each remaining file is parsed with its own copy of the state manager
+        # (in its own worker process when jobs > 1) and saved to the cache.
+        # The workers are forked so the calling scripts (which run at module
+        # level) are not re-imported; where fork isn't available the files are
+        # parsed in this process.
+        if len(work):
+            print(len(work), "of", len(file_list), "flight logs need to be parsed ...")
+        if jobs is None:
+            jobs = os.cpu_count()
+        jobs = min(jobs, len(work))
+        if jobs > 1 and "fork" in multiprocessing.get_all_start_methods():
+            print("parsing", len(work), "flight logs with", jobs, "worker processes ...")
+            with ProcessPoolExecutor(max_workers=jobs, mp_context=multiprocessing.get_context("fork")) as executor:
+                for stages in executor.map(_parse_file, work):
+                    perf.timer.stages.extend(stages)
+        else:
+            for args in work:
+                _parse_file(args)
 
-        # condition data collectors
-        for i in range(len(conditions)):
-            self.cond_list.append( [] )
+        # merge the per file results in file order
+        dt_stats = []
+        for file, entry_path in zip(file_list, entry_paths):
+            manifest = session_store.load_entry(entry_path)
+            manifest["stats"]["file"] = file
+            dt_stats.append(manifest["stats"])
+            flight_format = manifest["flight_format"]
+        dt = reconcile_dt(dt_stats)
+        print("Saving a memory mapped session of this data ...")
+        with perf.timer.stage("merge session"):
+            session_store.save_session(self.session_dir, entry_paths, keys, dt, dt_stats, flight_format, state_mgr.frame_layout(), self.dtype)
+        self.load_session(keys, state_mgr)
+        self.states = self.load_states(state_mgr, train_states)
+        self.set_conditions(conditions)
 
-        for file in file_list:
+    # memory map a saved session, returns False if there is no matching session
+    def load_session(self, keys, state_mgr):
+        result = session_store.load_session(self.session_dir, keys)
+        if result is None:
+            return False
+        frame, self.manifest = result
+        self.frame = state_mgr.unpack_frame(frame)
+        self.dt = self.manifest["dt"]
+        self.dt_stats = self.manifest["dt_stats"]
+        self.segments = np.array(self.manifest["segments"], dtype=int).reshape(-1, 2)
+        self.flight_format = self.manifest["flight_format"]
+        state_mgr.set_dt(self.dt)
+        print("session frame shape:", frame.shape)
+        return True
+
+    # the shared [train states x samples] matrix, built from the session
+    # frame (and saved for the next run with the same train states)
+    def load_states(self, state_mgr, train_states):
+        with perf.timer.stage("train states") as stage:
+            states = session_store.load_states(self.session_dir, self.manifest, train_states)
+            if states is None:
+                compute = lambda states, rows: self.compute_terms(state_mgr, train_states, states, rows)
+                session_store.save_states(self.session_dir, self.manifest, train_states, compute, self.dtype)
+                states = session_store.load_states(self.session_dir, self.manifest, train_states)
+            stage["shape"] = states.shape
+        print("train states shape:", states.shape)
+        return states
+
+    # select the samples of each flight condition (see condition_mask()),
+    # cheap enough to call again to re-bin the session
+    def set_conditions(self, conditions):
+        with perf.timer.stage("conditions", records=self.states.shape[1]):
+            self.cond_index = []
+            for condition in conditions:
+                self.cond_index.append( np.flatnonzero(condition_mask(self.frame, condition)) )
+        self.cond_list = ConditionList(self.states, self.cond_index)
+        for i in range(len(self.cond_index)):
+            print("condition", i, conditions[i], "samples:", len(self.cond_index[i]))
+
+    # compute the given rows of the train state matrix (states, with
+    # train_states[row] in each row) from the raw channel frame, all
+    # together (so they share their common subexpressions) and a slice of
+    # samples at a time
+    def compute_terms(self, state_mgr, train_states, states, rows):
+        names = [ train_states[row] for row in rows ]
+        print("computing train states:", names)
+        samples = self.manifest["samples"]
+        for start in range(0, samples, self.term_chunk):
+            end = min(start + self.term_chunk, samples)
+            chunk = {}
+            for key in self.frame:
+                chunk[key] = self.frame[key][...,start:end]
+            values = state_mgr.gen_state_matrix(names, chunk)
+            for j, row in enumerate(rows):
+                states[row,start:end] = values[j]
+
+    # parse one flight data log, returns the dt statistics and the
+    # [channels x samples] raw channel frame of the flying samples (see
+    # StateManager.frame_layout())
+    def parse_file(self, file, vehicle, invert_elevator, invert_rudder, state_mgr, batch=False):
+        with perf.timer.stage("load log") as stage:
             data, self.flight_format = flight_loader.load(file)
+            stage["records"] = len(data["imu"])
 
-            print("imu records:", len(data["imu"]))
-            print("gps records:", len(data["gps"]))
-            if "airdata" in data:
-                print("airdata records:", len(data["airdata"]))
-            if "act" in data:
-                print("actuator records:", len(data["act"]))
-            if "nav" in data:
-                print("nav records:", len(data["nav"]))
-            if len(data["imu"]) == 0 and len(data["gps"]) == 0:
-                print("not enough data loaded to continue.")
-                quit()
-
-            # dt estimation
-            print("Estimating median dt from IMU records:")
-            iter = flight_interp.IterateGroup(data)
-            last_time = None
-            dt_data = []
-            max_airspeed = 0
-            for i in tqdm(range(iter.size())):
-                record = iter.next()
-                if len(record):
-                    if "imu" in record:
-                        imupt = record["imu"]
-                        if last_time is None:
-                            last_time = imupt["timestamp"]
-                        dt_data.append(imupt["timestamp"] - last_time)
-                        last_time = imupt["timestamp"]
-                    if "airdata" in record:
-                        airpt = record["airdata"]
-                        if airpt["airspeed_mps"] > max_airspeed:
-                            max_airspeed = airpt["airspeed_mps"]
-            dt_data = np.array(dt_data)
-            print("IMU mean:", np.mean(dt_data))
-            print("IMU median:", np.median(dt_data))
-            imu_dt = float("%.4f" % np.median(dt_data))
-            print("imu dt:", imu_dt)
-            print("max airspeed in flight (mps):", max_airspeed )
-
-            self.dt = imu_dt
-            state_mgr.set_dt(imu_dt)
-
-            print("Parsing flight data log:")
-            actpt = {}
-            airpt = {}
-            navpt = {}
-            # g = np.array( [ 0, 0, -9.81 ] )
-
-            wn = 0
-            we = 0
-            wd = 0
-
-            pitot_scale = None
-            psi_bias = None
-            wn_interp = None
-            we_interp = None
-
-            # backup wind estimator if needed
-            windest = Wind()
-
-            if False and self.flight_format != "cirrus_pkl":
-                # note: wind estimates are only needed for estimating alpha/beta (or
-                # bvz/bvy) which is not needed if the aircraft is instrumented with
-                # alpha/beta vanes and these are measured directly.
-
-                from lib.wind2 import Wind2
-                w2 = Wind2()
-                pitot_scale, psi_bias, wn_interp, we_interp = w2.estimate( flight_interp.IterateGroup(data), imu_dt )
-
-            # iterate through the flight data log (a sequence of time samples of all the measured states)
-            iter = flight_interp.IterateGroup(data)
-            for i in tqdm(range(iter.size())):
-                record = iter.next()
-                if len(record) == 0:
-                    continue
-                # print(i, "record:", record)
-
-                # 1. Do the messy work of cherry picking out the direct measured states from each time sample
-                if "nav" in record:
-                    # need ahead of air in case we are doing a wind estimate
-                    navpt = record["nav"]
-                else:
-                    continue
-                if "imu" in record:
-                    imupt = record["imu"]
-                    state_mgr.set_time( imupt["timestamp"] )
-                    p = imupt["p_rps"]
-                    q = imupt["q_rps"]
-                    r = imupt["r_rps"]
-                    if "p_bias" in navpt:
-                        p -= navpt["p_bias"]
-                        q -= navpt["q_bias"]
-                        r -= navpt["r_bias"]
-                    state_mgr.set_gyros( np.array([p, q, r]) )
-                    ax = imupt["ax_mps2"]
-                    ay = imupt["ay_mps2"]
-                    az = imupt["az_mps2"]
-                    if "ax_bias" in navpt:
-                        ax -= navpt["ax_bias"]
-                        ay -= navpt["ay_bias"]
-                        az -= navpt["az_bias"]
-                    state_mgr.set_accels( np.array([ax, ay, az]) )
-                if "effectors" in record:
-                    actpt = record["effectors"]
-                    if vehicle == "wing":
-                        if "power" in actpt:
-                            state_mgr.set_throttle( actpt["power"] )
-                        else:
-                            state_mgr.set_throttle( actpt["throttle"] )
-                        ail = actpt["aileron"]
-                        ele = actpt["elevator"]
-                        rud = actpt["rudder"]
-                        if invert_elevator:
-                            ele = -ele
-                        if invert_rudder:
-                            rud = -rud
-                        if "flaps" in actpt:
-                            flaps = actpt["flaps"]
-                        else:
-                            flaps = 0
-                        state_mgr.set_flight_surfaces( ail, ele, rud, flaps )
-                    elif vehicle == "quad":
-                        state_mgr.set_motors( [ actpt["output[0]"],
-                                                    actpt["output[1]"],
-                                                    actpt["output[2]"],
-                                                    actpt["output[3]"] ] )
-                if "gps" in record:
-                    gpspt = record["gps"]
-                if "airdata" in record:
-                    airpt = record["airdata"]
-
-                    asi_mps = airpt["airspeed_mps"]
-                    # add in correction factor if available
-                    if pitot_scale is not None:
-                        asi_mps *= pitot_scale
-                    elif "pitot_scale" in airpt:
-                        asi_mps *= airpt["pitot_scale"]
-                    if "alpha" in airpt and "beta" in airpt:
-                        state_mgr.set_airdata( asi_mps, airpt["alpha"]*d2r, airpt["beta"]*d2r )
-                    else:
-                        state_mgr.set_airdata( asi_mps )
-                    if wn_interp is not None and we_interp is not None:
-                        # post process wind estimate
-                        wn = wn_interp(imupt["timestamp"])
-                        we = we_interp(imupt["timestamp"])
-                        wd = 0
-                    elif "wind_dir" in airpt:
-                        wind_psi = 0.5 * pi - airpt["wind_dir"] * d2r
-                        wind_mps = airpt["wind_speed"] * kt2mps
-                        we = cos(wind_psi) * wind_mps
-                        wn = sin(wind_psi) * wind_mps
-                        wd = 0
-                    elif False and flight_format == "cirrus_pkl" and state_mgr.is_flying():
-                        windest.update(imupt["timestamp"], airpt["airspeed"], navpt["psi"], navpt["vn"], navpt["ve"])
-                        wn = windest.filt_long_wn.value
-                        we = windest.filt_long_we.value
-                        wd = 0
-                        print("%.2f %.2f" % (wn, we))
-                if "nav" in record:
-                    navpt = record["nav"]
-                    if "phi_deg" in navpt:
-                        phi = navpt["phi_deg"] * d2r
-                    else:
-                        phi = navpt["roll_deg"] * d2r
-                    if "theta_deg" in navpt:
-                        theta = navpt["theta_deg"] * d2r
-                    else:
-                        theta = navpt["pitch_deg"] * d2r
-                    if "psi_deg" in navpt:
-                        psi = navpt["psi_deg"] * d2r
+        print("imu records:", len(data["imu"]))
+        print("gps records:", len(data["gps"]))
+        if "airdata" in data:
+            print("airdata records:", len(data["airdata"]))
+        if "act" in data:
+            print("actuator records:", len(data["act"]))
+        if "nav" in data:
+            print("nav records:", len(data["nav"]))
+        if len(data["imu"]) == 0 and len(data["gps"]) == 0:
+            # (raised rather than quit() so a worker process reports it)
+            raise Exception("not enough data loaded to continue:", file)
+
+        if batch:
+            with perf.timer.stage("parse log (batch)", records=len(data["imu"])) as stage:
+                stats, frame = self.parse_batch(data, vehicle, invert_elevator, invert_rudder, state_mgr)
+                stage["shape"] = frame.shape
+        else:
+            with perf.timer.stage("parse log", records=len(data["imu"])) as stage:
+                stats, frame = self.parse_records(data, vehicle, invert_elevator, invert_rudder, state_mgr)
+                stage["shape"] = frame.shape
+        stats["file"] = file
+        return stats, frame
+
+    # Step the state manager through every interpolated record of the log
+    # (interpolation, state updates and the raw channels in one pass.)
+    def parse_records(self, data, vehicle, invert_elevator, invert_rudder, state_mgr):
+        # The dt estimate (median imu time step) is collected in the same
+        # pass as the states.  Until dt is known the states are computed
+        # with a unit dt and alpha_dot is rescaled at the end.
+        if state_mgr.dt is not None:
+            state_mgr.alpha_dot *= state_mgr.dt
+        state_mgr.set_dt(1.0)
+        last_time = None
+        dt_data = []
+        max_airspeed = 0
+
+        print("Parsing flight data log:")
+        actpt = {}
+        airpt = {}
+        navpt = {}
+        # g = np.array( [ 0, 0, -9.81 ] )
+
+        wn = 0
+        we = 0
+        wd = 0
+
+        pitot_scale = None
+        psi_bias = None
+        wn_interp = None
+        we_interp = None
+
+        # backup wind estimator if needed
+        windest = Wind()
+
+        if False and self.flight_format != "cirrus_pkl":
+            # note: wind estimates are only needed for estimating alpha/beta (or
+            # bvz/bvy) which is not needed if the aircraft is instrumented with
+            # alpha/beta vanes and these are measured directly.
+
+            from lib.wind2 import Wind2
+            w2 = Wind2()
+            imu_dt = np.median(np.diff([imupt["timestamp"] for imupt in data["imu"]]))
+            pitot_scale, psi_bias, wn_interp, we_interp = w2.estimate( flight_interp.IterateGroup(data), imu_dt )
+
+        # iterate through the flight data log (a sequence of time samples of all the measured states)
+        # flying samples are written in place into a growable buffer
+        rows = ColumnBuffer(state_mgr.frame_width(), dtype=self.dtype)
+        segments = []   # [start, end) of each run of flying samples
+        iter = flight_interp.IterateGroup(data)
+        for i in tqdm(range(iter.size())):
+            record = iter.next()
+            if len(record) == 0:
+                continue
+            # print(i, "record:", record)
+
+            # 0. dt and airspeed statistics (from every record)
+            if "imu" in record:
+                imupt = record["imu"]
+                if last_time is None:
+                    last_time = imupt["timestamp"]
+                dt_data.append(imupt["timestamp"] - last_time)
+                last_time = imupt["timestamp"]
+            if "airdata" in record:
+                if record["airdata"]["airspeed_mps"] > max_airspeed:
+                    max_airspeed = record["airdata"]["airspeed_mps"]
+
+            # 1. Do the messy work of cherry picking out the direct measured states from each time sample
+            if "nav" in record:
+                # need ahead of air in case we are doing a wind estimate
+                navpt = record["nav"]
+            else:
+                continue
+            if "imu" in record:
+                imupt = record["imu"]
+                state_mgr.set_time( imupt["timestamp"] )
+                p = imupt["p_rps"]
+                q = imupt["q_rps"]
+                r = imupt["r_rps"]
+                if "p_bias" in navpt:
+                    p -= navpt["p_bias"]
+                    q -= navpt["q_bias"]
+                    r -= navpt["r_bias"]
+                state_mgr.set_gyros( np.array([p, q, r]) )
+                ax = imupt["ax_mps2"]
+                ay = imupt["ay_mps2"]
+                az = imupt["az_mps2"]
+                if "ax_bias" in navpt:
+                    ax -= navpt["ax_bias"]
+                    ay -= navpt["ay_bias"]
+                    az -= navpt["az_bias"]
+                state_mgr.set_accels( np.array([ax, ay, az]) )
+            if "effectors" in record:
+                actpt = record["effectors"]
+                if vehicle == "wing":
+                    if "power" in actpt:
+                        state_mgr.set_throttle( actpt["power"] )
                     else:
-                        psi = navpt["yaw_deg"] * d2r
-                    if psi_bias is not None:
-                        psi += psi_bias
-                    state_mgr.set_orientation( phi, theta, psi )
-                    state_mgr.set_pos(navpt["longitude_deg"], navpt["latitude_deg"], navpt["altitude_m"])
-                    if vehicle == "wing" or np.linalg.norm([navpt["vn"], navpt["ve"], navpt["vd"]]) > 0.000001:
-                        state_mgr.set_ned_velocity( navpt["vn_mps"], navpt["ve_mps"],
-                                                        navpt["vd_mps"], wn, we, wd )
+                        state_mgr.set_throttle( actpt["throttle"] )
+                    ail = actpt["aileron"]
+                    ele = actpt["elevator"]
+                    rud = actpt["rudder"]
+                    if invert_elevator:
+                        ele = -ele
+                    if invert_rudder:
+                        rud = -rud
+                    if "flaps" in actpt:
+                        flaps = actpt["flaps"]
                     else:
-                        state_mgr.set_ned_velocity( gpspt["vn_mps"], gpspt["ve_mps"],
-                                                        gpspt["vd_mps"], wn, we, wd )
-
-                # Our model is only valid during flight aloft, skip non-flying data points
-                if not state_mgr.is_flying():
-                    continue
-
-                # 2. Derived states
-                state_mgr.compute_derived_states(state_mgr.have_alpha)
-
-                # 3. Compute terms (combinations of states and derived states)
-                state_mgr.compute_terms()
-
-                state = state_mgr.gen_state_vector(train_states)
-                # print(state_mgr.state2dict(state))
-                for i, condition in enumerate(conditions):
-                    # print(i, condition)
-                    if "flaps" in condition and abs(state_mgr.flaps - condition["flaps"]) < 0.1:
-                        # print(True)
-                        self.cond_list[i].append( state )
-                        # if vehicle == "wing":
-                        #     params = [ state_mgr.alpha[0]*r2d, state_mgr.Cl_raw, 0, state_mgr.qbar,
-                        #                 state_mgr.accels[0][0], state_mgr.throttle[0] ]
-                        #     # print("params:", params)
-                        #     self.cond_list[i]["coeff"].append( params )
-
-        # convert train data lists into numpy arrays
-        for i in range(len(self.cond_list)):
-            self.cond_list[i] = np.array(self.cond_list[i]).T
-            print("cond_list shape:", self.cond_list[i].shape)
-
-        # cache our work
-        print("Saving a hickle (hdf5/pickle) cache of this session data...")
-        session = {}
-        session["flight_format"] = self.flight_format
-        session["file_list"] = self.file_list
-        session["cond_list"] = self.cond_list
-        session["train_states"] = self.train_states
-        session["dt"] = imu_dt
-        hickle.dump(session, self.session_file, mode='w')
+                        flaps = 0
+                    state_mgr.set_flight_surfaces( ail, ele, rud, flaps )
+                elif vehicle == "quad":
+                    state_mgr.set_motors( [ actpt["output[0]"],
+                                                actpt["output[1]"],
+                                                actpt["output[2]"],
+                                                actpt["output[3]"] ] )
+            if "gps" in record:
+                gpspt = record["gps"]
+            if "airdata" in record:
+                airpt = record["airdata"]
+
+                asi_mps = airpt["airspeed_mps"]
+                # add in correction factor if available
+                if pitot_scale is not None:
+                    asi_mps *= pitot_scale
+                elif "pitot_scale" in airpt:
+                    asi_mps *= airpt["pitot_scale"]
+                if "alpha" in airpt and "beta" in airpt:
+                    state_mgr.set_airdata( asi_mps, airpt["alpha"]*d2r, airpt["beta"]*d2r )
+                else:
+                    state_mgr.set_airdata( asi_mps )
+                if wn_interp is not None and we_interp is not None:
+                    # post process wind estimate
+                    wn = wn_interp(imupt["timestamp"])
+                    we = we_interp(imupt["timestamp"])
+                    wd = 0
+                elif "wind_dir" in airpt:
+                    wind_psi = 0.5 * pi - airpt["wind_dir"] * d2r
+                    wind_mps = airpt["wind_speed"] * kt2mps
+                    we = cos(wind_psi) * wind_mps
+                    wn = sin(wind_psi) * wind_mps
+                    wd = 0
+                elif False and flight_format == "cirrus_pkl" and state_mgr.is_flying():
+                    windest.update(imupt["timestamp"], airpt["airspeed"], navpt["psi"], navpt["vn"], navpt["ve"])
+                    wn = windest.filt_long_wn.value
+                    we = windest.filt_long_we.value
+                    wd = 0
+                    print("%.2f %.2f" % (wn, we))
+            if "nav" in record:
+                navpt = record["nav"]
+                if "phi_deg" in navpt:
+                    phi = navpt["phi_deg"] * d2r
+                else:
+                    phi = navpt["roll_deg"] * d2r
+                if "theta_deg" in navpt:
+                    theta = navpt["theta_deg"] * d2r
+                else:
+                    theta = navpt["pitch_deg"] * d2r
+                if "psi_deg" in navpt:
+                    psi = navpt["psi_deg"] * d2r
+                else:
+                    psi = navpt["yaw_deg"] * d2r
+                if psi_bias is not None:
+                    psi += psi_bias
+                state_mgr.set_orientation( phi, theta, psi )
+                state_mgr.set_pos(navpt["longitude_deg"], navpt["latitude_deg"], navpt["altitude_m"])
+                if vehicle == "wing" or np.linalg.norm([navpt["vn"], navpt["ve"], navpt["vd"]]) > 0.000001:
+                    state_mgr.set_ned_velocity( navpt["vn_mps"], navpt["ve_mps"],
+                                                    navpt["vd_mps"], wn, we, wd )
+                else:
+                    state_mgr.set_ned_velocity( gpspt["vn_mps"], gpspt["ve_mps"],
+                                                    gpspt["vd_mps"], wn, we, wd )
+
+            # Our model is only valid during flight aloft, skip non-flying data points
+            if not state_mgr.is_flying():
+                if len(segments) and segments[-1][1] is None:
+                    segments[-1][1] = len(rows)
+                continue
+            takeoff = not len(segments) or segments[-1][1] is not None
+            if takeoff:
+                segments.append( [len(rows), None] )
+
+            # 2. Derived states
+            state_mgr.compute_derived_states(state_mgr.have_alpha)
+            if takeoff:
+                # the history terms of a segment start over at its first
+                # sample
+                state_mgr.reset_history()
+
+            # 3. Compute terms (combinations of states and derived states)
+            state_mgr.compute_terms()
+
+            # 4. Keep the raw channels, the train states (and the condition
+            # each sample belongs to) are computed from these later
+            rows.append( state_mgr.gen_frame_vector() )
+
+        stats = dt_stats(dt_data, max_airspeed)
+        if len(segments) and segments[-1][1] is None:
+            segments[-1][1] = len(rows)
+        stats["segments"] = segments
+        imu_dt = stats["imu_dt"]
+        state_mgr.set_dt(imu_dt)
+        state_mgr.alpha_dot /= imu_dt
+
+        # now that dt is known, rescale alpha_dot
+        matrix = rows.finish()
+        frame = state_mgr.unpack_frame(matrix)
+        frame["alpha_dot"] /= imu_dt
+        frame["dt"][:] = imu_dt
+        return stats, matrix
+
+    # Vectorized version of the per-record parse loop above.  Each channel is
+    # pulled out of the log as whole numpy columns and aligned to the imu time
+    # stamps the same way flight_interp.IterateGroup delivers records (a
+    # channel record shows up with the first imu sample at or after its time
+    # stamp.)  The state manager history lists only advance when their setter
+    # is called, so the "_n" history terms are rebuilt from the sequence of
+    # setter events rather than simply shifting by samples (and start over
+    # at the first sample of each segment of flight, like the per-record
+    # loop's reset_history().)  The state
+    # manager is seeded from and left in the same state the per-record loop
+    # would leave it in, so batch and per-record files can be mixed.
+    def parse_batch(self, data, vehicle, invert_elevator, invert_rudder, state_mgr):
+        imu = _columns(data["imu"], ["timestamp", "p_rps", "q_rps", "r_rps", "ax_mps2", "ay_mps2", "az_mps2"])
+        imu_time = imu["timestamp"]
+
+        # dt estimation
+        max_airspeed = 0
+        if "airdata" in data and len(data["airdata"]):
+            air_time = np.array([airpt["timestamp"] for airpt in data["airdata"]])
+            asi = np.array([airpt["airspeed_mps"] for airpt in data["airdata"]])[air_time <= imu_time[-1]]
+            if len(asi):
+                max_airspeed = max(0, np.max(asi))
+        stats = dt_stats(np.diff(imu_time, prepend=imu_time[0]), max_airspeed)
+        imu_dt = stats["imu_dt"]
+        state_mgr.set_dt(imu_dt)
+
+        print("Parsing flight data log (batch):")
+
+        # only imu samples that deliver a fresh nav record are processed
+        nav_fields = ["timestamp", "phi_deg", "theta_deg", "psi_deg", "roll_deg", "pitch_deg", "yaw_deg",
+                      "longitude_deg", "latitude_deg", "altitude_m", "vn_mps", "ve_mps", "vd_mps",
+                      "p_bias", "q_bias", "r_bias", "ax_bias", "ay_bias", "az_bias"]
+        nav = _columns(data["nav"], nav_fields)
+        nav_idx, nav_fresh = _align(imu_time, nav["timestamp"])
+        proc = np.where(nav_fresh)[0]
+        size = len(proc)
+        nav_idx = nav_idx[proc]
+        depth = state_mgr.history + 1
+
+        # imu (bias corrected by the current nav record)
+        gyros = np.vstack( [imu["p_rps"][proc], imu["q_rps"][proc], imu["r_rps"][proc]] )
+        accels = np.vstack( [imu["ax_mps2"][proc], imu["ay_mps2"][proc], imu["az_mps2"][proc]] )
+        if "p_bias" in nav:
+            gyros -= np.vstack( [nav["p_bias"][nav_idx], nav["q_bias"][nav_idx], nav["r_bias"][nav_idx]] )
+        if "ax_bias" in nav:
+            accels -= np.vstack( [nav["ax_bias"][nav_idx], nav["ay_bias"][nav_idx], nav["az_bias"][nav_idx]] )
+        imu_count = np.arange(1, size+1)
+
+        # effectors (the setter events, the history rows are built below for
+        # the samples that are kept)
+        if "effectors" in data and len(data["effectors"]):
+            records = data["effectors"]
+            if vehicle == "wing":
+                if "power" in records[0]:
+                    act = _columns(records, ["timestamp", "power", "aileron", "elevator", "rudder", "flaps"])
+                    act["throttle"] = act["power"]
+                else:
+                    act = _columns(records, ["timestamp", "throttle", "aileron", "elevator", "rudder", "flaps"])
+                if "flaps" not in act:
+                    act["flaps"] = np.zeros(len(records))
+                if invert_elevator:
+                    act["elevator"] = -act["elevator"]
+                if invert_rudder:
+                    act["rudder"] = -act["rudder"]
+            elif vehicle == "quad":
+                act = _columns(records, ["timestamp", "output[0]", "output[1]", "output[2]", "output[3]"])
+            act_idx, act_fresh = _events(imu_time, act["timestamp"], proc)
+            act_count = np.cumsum(act_fresh)
+            act_applied = act_idx[act_fresh]
+        else:
+            act = None
+
+        # airdata
+        have_alpha = state_mgr.have_alpha
+        air_alpha = None
+        if "airdata" in data and len(data["airdata"]):
+            records = data["airdata"]
+            air = _columns(records, ["timestamp", "airspeed_mps", "pitot_scale", "alpha", "beta", "wind_dir", "wind_speed"])
+            air_idx, air_fresh = _events(imu_time, air["timestamp"], proc)
+            air_count = np.cumsum(air_fresh)
+            applied = air_idx[air_fresh]
+            asi_mps = air["airspeed_mps"][applied]
+            if "pitot_scale" in air:
+                asi_mps = asi_mps * air["pitot_scale"][applied]
+            vc_mps = _history(asi_mps, air_count, 1, [state_mgr.vc_mps])[0]
+            if "alpha" in air and "beta" in air:
+                have_alpha = True
+                air_alpha = air["alpha"][applied]*d2r
+                air_beta = air["beta"][applied]*d2r
+            if "wind_dir" in air:
+                wind_psi = 0.5 * pi - air["wind_dir"][applied] * d2r
+                wind_mps = air["wind_speed"][applied] * kt2mps
+                wn = _history(np.sin(wind_psi) * wind_mps, air_count, 1, [0])[0]
+                we = _history(np.cos(wind_psi) * wind_mps, air_count, 1, [0])[0]
+            else:
+                wn = np.zeros(size)
+                we = np.zeros(size)
+        else:
+            vc_mps = np.full(size, state_mgr.vc_mps)
+            wn = np.zeros(size)
+            we = np.zeros(size)
+
+        # nav
+        if "phi_deg" in nav:
+            phi = nav["phi_deg"][nav_idx] * d2r
+        else:
+            phi = nav["roll_deg"][nav_idx] * d2r
+        if "theta_deg" in nav:
+            the = nav["theta_deg"][nav_idx] * d2r
+        else:
+            the = nav["pitch_deg"][nav_idx] * d2r
+        if "psi_deg" in nav:
+            psi = nav["psi_deg"][nav_idx] * d2r
+        else:
+            psi = nav["yaw_deg"][nav_idx] * d2r
+        alt = nav["altitude_m"][nav_idx]
+        vel_ned = np.vstack( [nav["vn_mps"][nav_idx], nav["ve_mps"][nav_idx], nav["vd_mps"][nav_idx]] )
+        if vehicle == "quad" and "gps" in data and len(data["gps"]):
+            gps = _columns(data["gps"], ["timestamp", "vn_mps", "ve_mps", "vd_mps"])
+            gps_idx, gps_fresh = _events(imu_time, gps["timestamp"], proc)
+            gps_count = np.cumsum(gps_fresh)
+            applied = gps_idx[gps_fresh]
+            still = np.linalg.norm(vel_ned, axis=0) <= 0.000001
+            for j, key in enumerate(["vn_mps", "ve_mps", "vd_mps"]):
+                gps_vel = _history(gps[key][applied], gps_count, 1, [0])[0]
+                vel_ned[j,still] = gps_vel[still]
+        vel_ned[0] += wn
+        vel_ned[1] += we
+        gs_mps = np.sqrt( vel_ned[0]**2 + vel_ned[1]**2 )
+
+        # Our model is only valid during flight aloft.  The flying samples
+        # are found first and the frame is only built for them (plus the
+        # last sample, where the state manager is left), the history rows
+        # still follow every setter event.
+        ground_alt = np.minimum.accumulate(alt)
+        if state_mgr.ground_alt is not None:
+            ground_alt = np.minimum(ground_alt, state_mgr.ground_alt)
+        flying = _flying_mask(state_mgr, imu_time[proc], gs_mps, vc_mps, alt, ground_alt)
+        fly = np.where(flying)[0]
+        stats["segments"] = _segments(flying)
+        takeoff = _last_takeoff(flying)
+        keep = fly
+        if size:
+            keep = np.append(fly, size - 1)
+        count = len(keep)
+        no_events = np.zeros(size, dtype=int)
+
+        frame = {}
+        floor = _floor(imu_count, takeoff)[keep]
+        frame["gyros"] = np.stack( [_history(gyros[j], imu_count[keep], depth, [g[j] for g in state_mgr.gyros], floor) for j in range(3)], axis=1 )
+        frame["accels"] = np.stack( [_history(accels[j], imu_count[keep], depth, [a[j] for a in state_mgr.accels], floor) for j in range(3)], axis=1 )
+        if vehicle == "wing":
+            for name, lo in [ ("throttle", 0), ("aileron", -1), ("elevator", -1), ("rudder", -1) ]:
+                if act is not None:
+                    vals = np.clip(act[name][act_applied], lo, 1)
+                    frame[name] = _history(vals, act_count[keep], depth, getattr(state_mgr, name), _floor(act_count, takeoff)[keep])
+                else:
+                    frame[name] = _history(np.zeros(0), no_events[keep], depth, getattr(state_mgr, name), _floor(no_events, takeoff)[keep])
+            if act is not None:
+                frame["flaps"] = _history(np.clip(act["flaps"][act_applied], 0, 1), act_count[keep], 1, [state_mgr.flaps])[0]
+            else:
+                frame["flaps"] = np.full(count, state_mgr.flaps)
+            frame["thrust"] = np.sqrt(frame["throttle"][0]) * 0.75 * abs(gravity)
+        elif vehicle == "quad":
+            motors = []
+            for j in range(4):
+                if act is not None:
+                    motors.append( _history(act["output[%d]" % j][act_applied], act_count[keep], 1, [state_mgr.motors[j]])[0] )
+                else:
+                    motors.append( np.full(count, state_mgr.motors[j]) )
+            frame["motors"] = np.vstack(motors)
+            frame["flaps"] = np.full(count, state_mgr.flaps)
+        frame["vc_mps"] = vc_mps[keep]
+        if air_alpha is not None:
+            floor = _floor(air_count, takeoff)[keep]
+            frame["alpha"] = _history(air_alpha, air_count[keep], depth, state_mgr.alpha, floor)
+            frame["beta"] = _history(air_beta, air_count[keep], depth, state_mgr.beta, floor)
+            # alpha_dot is computed in set_airdata() from the history at that
+            # moment (before any reset)
+            alpha = _history(air_alpha, air_count[keep], 2, state_mgr.alpha)
+            frame["alpha_dot"] = (alpha[0] - alpha[1]) / imu_dt
+        elif have_alpha:
+            # alpha/beta vanes seen in a previous log, hold the last values
+            floor = _floor(no_events, takeoff)[keep]
+            frame["alpha"] = _history([], no_events[keep], depth, state_mgr.alpha, floor)
+            frame["beta"] = _history([], no_events[keep], depth, state_mgr.beta, floor)
+            frame["alpha_dot"] = np.full(count, (state_mgr.alpha[0] - state_mgr.alpha[1]) / imu_dt)
+        else:
+            frame["alpha_dot"] = np.full(count, state_mgr.alpha_dot)
+        frame["alt"] = alt[keep]
+
+        # 2. Derived states (flying samples only)
+        derived = state_mgr.compute_derived_states_batch(phi[fly], the[fly], psi[fly], vel_ned[:,fly], have_alpha)
+        if not have_alpha:
+            # alpha and beta estimates from body frame velocity
+            fly_count = np.cumsum(flying)
+            floor = _floor(fly_count, takeoff)[keep]
+            frame["alpha"] = _history(derived["alpha"], fly_count[keep], depth, state_mgr.alpha, floor)
+            frame["beta"] = _history(derived["beta"], fly_count[keep], depth, state_mgr.beta, floor)
+
+        # leave the state manager where the per-record loop would have left it
+        if size:
+            last = size - 1
+            state_mgr.set_time(imu_time[proc][last])
+            for name in ["gyros", "accels"]:
+                getattr(state_mgr, name).fill(frame[name][:,:,-1])
+            for name in ["throttle", "aileron", "elevator", "rudder", "alpha", "beta"]:
+                if name in frame:
+                    getattr(state_mgr, name).fill(frame[name][:,-1])
+            if "flaps" in frame:
+                state_mgr.flaps = frame["flaps"][-1]
+            if "thrust" in frame:
+                state_mgr.thrust = frame["thrust"][-1]
+            if "motors" in frame:
+                state_mgr.motors = frame["motors"][:,-1].tolist()
+            state_mgr.vc_mps = frame["vc_mps"][-1]
+            state_mgr.alpha_dot = frame["alpha_dot"][-1]
+            state_mgr.set_orientation(phi[last], the[last], psi[last])
+            state_mgr.set_pos(nav["longitude_deg"][nav_idx[last]], nav["latitude_deg"][nav_idx[last]], alt[last])
+            state_mgr.ground_alt = ground_alt[last]
+            state_mgr.vel_ned = vel_ned[:,last].copy()
+            state_mgr.gs_mps = gs_mps[last]
+            state_mgr.have_alpha = have_alpha
+
+        # drop the last sample again
+        for key in frame:
+            frame[key] = frame[key][...,:len(fly)]
+        frame["g_body"] = derived["g_body"]
+
+        # 3. Compute terms (combinations of states and derived states)
+        frame.update(state_mgr.compute_terms_batch(frame["vc_mps"], frame["accels"][0], frame["alpha"][0], frame["beta"][0], phi[fly], the[fly]))
+
+        frame["dt"] = np.full(len(fly), imu_dt)
+        return stats, state_mgr.pack_frame(frame, len(fly), self.dtype)
+
+# process pool entry point: parse one file with its own TrainData and
+# StateManager and save the result to the session cache
+def _parse_file(work):
+    entry_path, dtype, args = work
+    train_data = TrainData()
+    train_data.dtype = dtype
+    mark = len(perf.timer.stages)
+    stats, frame = train_data.parse_file(*args)
+    segments = stats.pop("segments")
+    state_mgr = args[4]
+    with perf.timer.stage("save log cache"):
+        session_store.save_entry(entry_path, stats, frame, train_data.flight_format, state_mgr.frame_layout(), segments)
+    # (for worker processes to pass back)
+    return perf.timer.stages[mark:]
+
+# Frame channels a flight condition can select samples on.  A condition is a
+# dict of channel: value, a single value selects the samples within 0.1 of it
+# (flaps settings), a [min, max] pair selects min <= x < max (either end may
+# be None.)  History channels use their current value.
+condition_channels = [ "flaps", "vc_mps", "qbar", "alt", "throttle" ]
+
+def condition_mask(frame, condition):
+    mask = np.ones(frame["vc_mps"].shape[-1], dtype=bool)
+    for key, value in condition.items():
+        if key not in condition_channels:
+            raise Exception("Sorry, unknown condition channel requested:", key)
+        column = frame[key]
+        if column.ndim > 1:
+            column = column[0]
+        if isinstance(value, (list, tuple)):
+            if value[0] is not None:
+                mask &= column >= value[0]
+            if value[1] is not None:
+                mask &= column < value[1]
+        else:
+            mask &= np.abs(column - value) < 0.1
+    return mask
+
+# bump when the parse output changes so stale cache entries are not reused
+cache_version = 5
+
+# everything besides the log contents that affects how a log is parsed
+def parse_params(vehicle, invert_elevator, invert_rudder, state_mgr):
+    params = {
+        "version": cache_version,
+        "vehicle": vehicle,
+        "invert_elevator": invert_elevator,
+        "invert_rudder": invert_rudder,
+        "airborne_thresh_mps": state_mgr.airborne_thresh_mps,
+        "land_thresh_mps": state_mgr.land_thresh_mps,
+        "rho": state_mgr.rho,
+        "mass_kg": state_mgr.mass_kg,
+        "wing_area": state_mgr.wing_area,
+        "layout": state_mgr.frame_layout(),
+    }
+    return params
+
+# hash of the contents of a flight log (a file or a directory of files.)
+# Hashes are remembered by path, size and modification time so unchanged logs
+# are not re-read every run.
+def content_hash(path, cache_dir):
+    index_file = os.path.join(cache_dir, "content_hashes.json")
+    index = {}
+    if os.path.exists(index_file):
+        with open(index_file, "r") as f:
+            index = json.load(f)
+    if os.path.isdir(path):
+        files = []
+        for dirpath, dirnames, filenames in os.walk(path):
+            dirnames.sort()
+            for name in sorted(filenames):
+                files.append( os.path.join(dirpath, name) )
+    else:
+        files = [ path ]
+    signature = []
+    for name in files:
+        st = os.stat(name)
+        signature.append( [os.path.relpath(name, path), st.st_size, st.st_mtime_ns] )
+    abspath = os.path.abspath(path)
+    if abspath in index and index[abspath]["signature"] == signature:
+        return index[abspath]["hash"]
+    h = hashlib.sha256()
+    for name in files:
+        h.update(os.path.relpath(name, path).encode())
+        with open(name, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                h.update(chunk)
+    index[abspath] = { "signature": signature, "hash": h.hexdigest() }
+    with open(index_file, "w") as f:
+        json.dump(index, f, indent=1)
+    return index[abspath]["hash"]
+
+# cache key for one parsed flight log
+def cache_key(file, params, cache_dir):
+    h = hashlib.sha256()
+    h.update(content_hash(file, cache_dir).encode())
+    h.update(json.dumps(params, sort_keys=True).encode())
+    return h.hexdigest()[:32]
+
+# pick a single dt for the session from the per file estimates (the median
+# weighted by the number of imu records in each file.)  The fitted model
+# assumes one dt, so complain about any files that don't agree with it.
+def reconcile_dt(dt_stats):
+    if not len(dt_stats):
+        return None
+    dts = np.array([ stats["imu_dt"] for stats in dt_stats ])
+    weights = np.array([ stats["imu_records"] for stats in dt_stats ])
+    order = np.argsort(dts)
+    cumulative = np.cumsum(weights[order])
+    dt = float(dts[order][np.searchsorted(cumulative, 0.5 * cumulative[-1])])
+    for stats in dt_stats:
+        if abs(stats["imu_dt"] - dt) > 0.01 * dt:
+            print("WARNING: dt of", stats["file"], "(%.4f)" % stats["imu_dt"], "differs from the session dt (%.4f)" % dt)
+    print("session dt:", dt)
+    return dt
+
+# summarize the imu time steps of a flight log
+def dt_stats(dt_data, max_airspeed):
+    dt_data = np.array(dt_data)
+    stats = {}
+    stats["mean"] = float(np.mean(dt_data))
+    stats["median"] = float(np.median(dt_data))
+    stats["imu_dt"] = float("%.4f" % stats["median"])
+    stats["max_airspeed_mps"] = float(max_airspeed)
+    stats["imu_records"] = len(dt_data)
+    print("IMU mean:", stats["mean"])
+    print("IMU median:", stats["median"])
+    print("imu dt:", stats["imu_dt"])
+    print("max airspeed in flight (mps):", stats["max_airspeed_mps"])
+    return stats
+
+# pull the named fields (when present) out of a list of log records as numpy
+# columns
+def _columns(records, fields):
+    result = {}
+    if len(records):
+        for field in fields:
+            if field in records[0]:
+                result[field] = np.array([pt[field] for pt in records], dtype=float)
+    return result
+
+# index of the most recent record at or before each imu time stamp, and
+# whether that record is new since the previous imu sample (i.e. the record is
+# delivered with this sample by flight_interp.IterateGroup)
+def _align(imu_time, rec_time):
+    idx = np.searchsorted(rec_time, imu_time, side="right") - 1
+    prev = np.concatenate( ([-1], idx[:-1]) )
+    fresh = (idx != prev) & (idx >= 0)
+    return idx, fresh
+
+# same as _align(), but reduced to the processed (fresh nav) samples
+def _events(imu_time, rec_time, proc):
+    idx, fresh = _align(imu_time, rec_time)
+    return idx[proc], fresh[proc]
+
+# rebuild a state manager history list over a whole log.  values holds the
+# value passed to the setter at each event, count is the number of events up
+# to and including each sample, and seed is the state manager history list
+# before the first event (newest first.)  Row n of the result is the value n
+# events back, so result[n] matches list[n] in the state manager.  floor
+# (optional) is the event count at the last history reset before each sample
+# (see _floor()), the rows don't reach back past the value at the reset.
+def _history(values, count, depth, seed, floor=None):
+    values = np.asarray(values, dtype=float)
+    seed = np.array(list(seed) + [0.0]*depth, dtype=float)
+    hist = np.empty( (depth, len(count)) )
+    for n in range(depth):
+        j = count - 1 - n
+        back = n - np.minimum(count, n)
+        if floor is not None:
+            reset = floor >= 0
+            j = np.where(reset, np.maximum(j, floor - 1), j)
+            back = np.where(reset, 0, back)
+        row = seed[np.minimum(back, len(seed) - 1)]
+        if len(values):
+            new = j >= 0
+            row[new] = values[j[new]]
+        hist[n] = row
+    return hist
+
+# the StateManager.is_flying() hysteresis over whole columns: a sample that
+# only meets the start (stop) condition sets (clears) the flying state and
+# the state carries forward over samples that meet neither
+def _flying_mask(state_mgr, time, gs_mps, vc_mps, alt, ground_alt):
+    if state_mgr.vehicle == "wing":
+        start = (gs_mps > state_mgr.airborne_thresh_mps*0.7) & (vc_mps > state_mgr.airborne_thresh_mps)
+        stop = (gs_mps < state_mgr.airborne_thresh_mps*1.2) & (vc_mps < state_mgr.land_thresh_mps)
+    elif state_mgr.vehicle == "quad":
+        start = alt > ground_alt + 2
+        stop = alt < ground_alt + 1
+    initial = state_mgr.flying
+    if np.any(start & stop):
+        # overlapping thresholds toggle the state, step through the events
+        values = start.copy()
+        state = initial
+        for i in np.flatnonzero(start | stop):
+            if not state and start[i]:
+                state = True
+            elif state and stop[i]:
+                state = False
+            values[i] = state
+        flying = _hold(values, start | stop, initial)
+    else:
+        flying = _hold(start, start | stop, initial)
+    previous = np.concatenate( [[initial], flying[:-1]] )
+    for i in np.flatnonzero(flying != previous):
+        if flying[i]:
+            print("Start flying @ %.2f" % time[i])
+        else:
+            print("Stop flying @ %.2f" % time[i])
+    if len(flying):
+        state_mgr.flying = bool(flying[-1])
+    return flying
+
+# values[i] at the samples where event[i], carried forward to the following
+# samples (initial before the first event)
+def _hold(values, event, initial):
+    last_event = np.maximum.accumulate( np.where(event, np.arange(len(event)), -1) )
+    return np.where(last_event >= 0, values[np.maximum(last_event, 0)], initial)
+
+# the sample of the last take off (the first sample of a run of flying) at or
+# before each sample, -1 before the first one
+def _last_takeoff(flying):
+    takeoff = flying & ~np.concatenate( [[False], flying[:-1]] )
+    return np.maximum.accumulate( np.where(takeoff, np.arange(len(flying)), -1) )
+
+# the event count (see _history()) at the last take off before each sample,
+# where the history is reset, -1 before the first take off
+def _floor(count, takeoff):
+    return np.where(takeoff >= 0, count[np.maximum(takeoff, 0)], -1)
+
+# the contiguous runs of flying samples as [start, end) sample ranges of the
+# flying samples only (the rows of the frame.)  The history terms start over
+# at the first sample of each run.
+def _segments(flying):
+    edges = np.diff(flying.astype(np.int8), prepend=0, append=0)
+    lengths = np.flatnonzero(edges == -1) - np.flatnonzero(edges == 1)
+    ends = np.cumsum(lengths)
+    return np.column_stack( [ends - lengths, ends] ).tolist()
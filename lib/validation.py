@@ -0,0 +1,172 @@
+# Blocked cross validation of the state transition fit.
+#
+# The samples are split into folds of contiguous time blocks (or of whole
+# flights, the session segments) and the Gram matrix of every fold is summed
+# once (lib/gram.py.)  The fit for fold k is solved from the total minus fold
+# k and scored on fold k:
+#
+#   one step: the error of predicting each next sample from the logged
+#             current one, straight from the Gram quantities of the fold
+#   free run: the fit is stepped through the fold feeding its own output
+#             estimates (and their history) forward like simulate() does,
+#             starting over from the logged data at each segment of flight
+#
+# The fold Grams hold all the train states, so any subset of the terms is
+# cross validated without another pass over the data (free run excepted.)
+
+import numpy as np
+
+from lib import gram
+from lib.history import history_map
+
+# [start, end) ranges of folds contiguous blocks of size samples, one list of
+# ranges per fold
+def time_blocks(size, folds):
+    bounds = np.linspace(0, size, folds + 1).astype(int)
+    return [ [ [bounds[k], bounds[k+1]] ] for k in range(folds) ]
+
+# whole segments (continuous runs of flight, see TrainData.segments) per
+# fold, balanced by number of samples: the largest segment left goes to the
+# fold with the fewest samples so far.  columns: the session samples the
+# states are indexed by (a condition's index), the segments are mapped to
+# positions in it.  Returns None when fewer segments than folds have samples
+# (a fold would be empty.)
+def segment_blocks(segments, folds, columns=None):
+    ranges = []
+    for start, end in segments:
+        if columns is not None:
+            start, end = np.searchsorted(columns, [start, end])
+        if end - start > 1:
+            ranges.append( [int(start), int(end)] )
+    if len(ranges) < folds:
+        return None
+    blocks = [ [] for k in range(folds) ]
+    sizes = np.zeros(folds, dtype=int)
+    for r in sorted(ranges, key=lambda r: r[0] - r[1]):
+        k = int(np.argmin(sizes))
+        blocks[k].append(r)
+        sizes[k] += r[1] - r[0]
+    return [ sorted(block) for block in blocks ]
+
+class CrossValidation():
+    # states: [train states x samples] (or the session states with columns
+    # selecting the samples), names: the train state names, outputs: the
+    # output state names.  Folds are whole segments when at least as many
+    # segments as folds have samples, contiguous time blocks otherwise.  Samples
+    # are only paired within a segment either way.
+    def __init__(self, states, names, outputs, folds=5, segments=None, columns=None):
+        self.states = states
+        self.names = list(names)
+        self.columns = columns
+        self.segments = segments
+        self.outputs = [ self.names.index(x) for x in outputs ]
+        size = states.shape[1] if columns is None else len(columns)
+        self.blocks = None
+        if segments is not None:
+            self.blocks = segment_blocks(segments, folds, columns)
+        if self.blocks is not None:
+            print("cross validation: %d folds of whole flight segments" % folds)
+        else:
+            self.blocks = time_blocks(size, folds)
+            print("cross validation: %d folds of contiguous time blocks" % folds)
+        terms = list(range(len(self.names)))
+        self.grams = []
+        self.total = gram.Gram(len(terms), len(self.outputs))
+        for ranges in self.blocks:
+            fold = gram.Gram(len(terms), len(self.outputs))
+            for start, end in ranges:
+                fold.append( gram.accumulate(self.states, terms, self.outputs, self._samples(start, end),
+                                             segments=segments) )
+            self.grams.append(fold)
+            self.total.append(fold)
+        self.propagate_src, self.propagate_dst = history_map(self.names)
+
+    def _columns(self, start, end):
+        if self.columns is None:
+            return self.states[:,start:end]
+        return self.states[:,self.columns[start:end]]
+
+    # the samples of states at positions start:end
+    def _samples(self, start, end):
+        if self.columns is None:
+            return np.arange(start, end)
+        return np.asarray(self.columns[start:end])
+
+    # the [start, end) positions of the runs of consecutive paired samples in
+    # start:end (split at the segment boundaries)
+    def _runs(self, start, end):
+        samples = self._samples(start, end)
+        if self.segments is None:
+            return [ [start, end] ]
+        same = gram.same_segment(samples[:-1], samples[1:], self.segments)
+        cuts = np.flatnonzero(~same) + 1
+        bounds = np.concatenate( [[0], cuts, [len(samples)]] ) + start
+        return [ [int(a), int(b)] for a, b in zip(bounds[:-1], bounds[1:]) ]
+
+    # step the fit A (outputs x terms) through the samples, feeding the
+    # output estimates forward.  Returns the estimates of samples 1..n-1.
+    def _free_run(self, data, terms, A):
+        est = np.empty( (len(self.outputs), data.shape[1] - 1) )
+        for i in range(data.shape[1] - 1):
+            next = A @ data[terms,i]
+            data[self.propagate_dst,i+1] = data[self.propagate_src,i]
+            data[self.outputs,i+1] = next
+            est[:,i] = next
+        return est
+
+    # cross validate the fit of the outputs over terms (names, default all
+    # the train states.)  Returns a dict of output -> { "one_step_rms",
+    # "one_step_percent", "free_run_rms", "free_run_percent", "folds" (one
+    # step rms of each fold) }, rms being the root mean square error and
+    # percent that relative to the np.std() of the output.
+    def evaluate(self, terms=None, free_run=True, method="cholesky"):
+        if terms is None:
+            terms = self.names
+        idx = [ self.names.index(x) for x in terms ]
+        outputs = list(range(len(self.outputs)))
+        sq = np.zeros( (2, len(outputs)) )     # one step, free run
+        count = np.zeros(2)
+        fold_rms = []
+        y_sum = np.zeros(len(outputs))
+        y_sq = np.zeros(len(outputs))
+        for k, fold in enumerate(self.grams):
+            A = self.total.remove(fold).subset(idx, outputs).solve(method)
+            rss = fold.subset(idx, outputs).error(A)
+            sq[0] += rss
+            count[0] += fold.samples
+            fold_rms.append( np.sqrt(rss / max(fold.samples, 1)) )
+            y_sum += fold.sy
+            y_sq += np.diag(fold.YY)
+            if free_run:
+                with np.errstate(over="ignore", invalid="ignore"):
+                    for block in self.blocks[k]:
+                        for start, end in self._runs(*block):
+                            if end - start < 2:
+                                continue
+                            data = np.array(self._columns(start, end), dtype=np.float64)
+                            truth = data[self.outputs,1:].copy()
+                            est = self._free_run(data, idx, A)
+                            sq[1] += np.sum((truth - est)**2, axis=1)
+                            count[1] += est.shape[1]
+        y_std = np.sqrt(np.maximum(y_sq / count[0] - (y_sum / count[0])**2, 0))
+        rms = np.sqrt(sq / np.maximum(count, 1)[:,None])
+        with np.errstate(divide="ignore", invalid="ignore"):
+            percent = 100 * rms / y_std
+        result = {}
+        for i, o in enumerate(self.outputs):
+            result[self.names[o]] = {
+                "one_step_rms": float(rms[0,i]),
+                "one_step_percent": float(percent[0,i]),
+                "free_run_rms": float(rms[1,i]) if free_run else None,
+                "free_run_percent": float(percent[1,i]) if free_run else None,
+                "folds": [ float(f[i]) for f in fold_rms ],
+            }
+        return result
+
+    def report(self, result):
+        print("cross validation (%d folds):" % len(self.grams))
+        for name, r in result.items():
+            line = "  %s: one step rms: %.4g (%.2f%%)" % (name, r["one_step_rms"], r["one_step_percent"])
+            if r["free_run_rms"] is not None:
+                line += " free run rms: %.4g (%.2f%%)" % (r["free_run_rms"], r["free_run_percent"])
+            print(line)
@@ -17,6 +17,9 @@ from matplotlib import pyplot as plt
 import numpy as np
 
 from lib.constants import kt2mps
+from lib import gram
+from lib import selection
+from lib.history import history_map
 from lib.state_mgr import StateManager
 from lib.system_id import SystemIdentification
 from lib.traindata import TrainData
@@ -28,6 +31,9 @@ parser.add_argument("--write", required=True, help="write model file name")
 parser.add_argument("--vehicle", default="wing", choices=["wing", "quad"], help="vehicle type represented by data file")
 parser.add_argument("--invert-elevator", action='store_true', help="invert direction of elevator")
 parser.add_argument("--invert-rudder", action='store_true', help="invert direction of rudder")
+parser.add_argument("--batch", action='store_true', help="vectorized (whole log at a time) flight data ingestion")
+parser.add_argument("--jobs", type=int, help="number of flight logs to parse in parallel (default: number of cpus)")
+parser.add_argument("--history", type=int, default=4, help="number of past values kept for the _n history terms (1-9)")
 args = parser.parse_args()
 
 # question 1: seem to get a better flaps up fit to airspeed (vs. qbar) but fails to converge for 50% flaps
@@ -121,32 +127,17 @@ conditions = [
     { "flaps": 1.0 },
 ]
 
-state_mgr = StateManager(args.vehicle)
+state_mgr = StateManager(args.vehicle, history=args.history)
 train_states = inceptor_terms + inceptor_airdata_terms + inertial_terms + airdata_terms
 state_mgr.set_state_names(inceptor_terms, inertial_terms + airdata_terms, output_states)
 
 # previous state propagation
-propagate = []
-for i, s in enumerate(train_states):
-    if len(s) >= 3 and s[-2] == "_":
-        print("evaluating:", s)
-        n = int(s[-1])
-        root = s[:-2]
-        if n == 1:
-            if root in train_states:
-                src = train_states.index(root)
-            else:
-                print("ERROR: requested state history without finding the current state:", s, "->", root)
-                quit()
-        else:
-            newer = root + "_%d" % (n-1)
-            if newer in train_states:
-                src = train_states.index(newer)
-            else:
-                print("ERROR: requested state history without finding the current state:", s, "->", newer)
-                quit()
-        dst = i
-        propagate.append( [src, dst] )
+try:
+    propagate_src, propagate_dst = history_map(train_states)
+except Exception as e:
+    print("ERROR:", *e.args)
+    quit()
+propagate = [ [src, dst] for src, dst in zip(propagate_src.tolist(), propagate_dst.tolist()) ]
 print("Previous state propagation:", propagate)
 
 # state_mgr.set_is_flying_thresholds(15*kt2mps, 10*kt2mps) # bob ross
@@ -154,7 +145,7 @@ print("Previous state propagation:", propagate)
 state_mgr.set_is_flying_thresholds(10*kt2mps, 15*kt2mps) # skywalker
 
 train_data = TrainData()
-train_data.load_flightdata(args.flight, args.vehicle, args.invert_elevator, args.invert_rudder, state_mgr, conditions, train_states)
+train_data.load_flightdata(args.flight, args.vehicle, args.invert_elevator, args.invert_rudder, state_mgr, conditions, train_states, batch=args.batch, jobs=args.jobs)
 
 print("train_data.cond_list[0].shape:", train_data.cond_list[0].shape)
 # train_data.cond_list[0] = np.delete(train_data.cond_list[0], slice(526889,527132), axis=1)
@@ -172,9 +163,10 @@ print("train_data.cond_list[0].shape:", train_data.cond_list[0].shape)
 print("Conditions report:")
 for i, cond in enumerate(conditions):
     print(i, cond)
-    if len(train_data.cond_list[i]):
-        print("  Number of states:", len(train_data.cond_list[i][0]))
-        print("  Input state vectors:", len(train_data.cond_list[i]))
+    traindata = train_data.cond_list[i]
+    if len(traindata):
+        print("  Number of states:", len(traindata[0]))
+        print("  Input state vectors:", len(traindata))
 
 # signal smoothing experiment
 from scipy import signal
@@ -198,12 +190,13 @@ def do_filter(traindata, dt):
 # find/filter not-useful interpolated sections
 from scipy.ndimage import gaussian_filter1d
 for i, cond in enumerate(conditions):
-    print(i, "len:", len(train_data.cond_list[i]))
-    if not len(train_data.cond_list[i]):
+    print(i, "len:", len(train_data.cond_index[i]))
+    if not len(train_data.cond_index[i]):
         continue
-    ax = train_data.cond_list[i][train_states.index("ax")]
-    ay = train_data.cond_list[i][train_states.index("ay")]
-    az = train_data.cond_list[i][train_states.index("az")]
+    traindata = train_data.cond_list[i]
+    ax = traindata[train_states.index("ax")]
+    ay = traindata[train_states.index("ay")]
+    az = traindata[train_states.index("az")]
     accel = np.sqrt( ax*ax + ay*ay + az*az )
 
     # cutoff_freq = 0.05
@@ -237,9 +230,10 @@ for i, cond in enumerate(conditions):
     # plt.legend()
     # plt.show()
 
-    # now delete those segments!
+    # now delete those segments! (from the condition's sample index, the
+    # shared train data is untouched)
     for segment in reversed(segments):
-        train_data.cond_list[i] = np.delete(train_data.cond_list[i], slice(segment[0],segment[1]), axis=1)
+        train_data.cond_index[i] = np.delete(train_data.cond_index[i], slice(segment[0],segment[1]))
 
 def solve(traindata, includes_idx, solutions_idx):
     srcdata = traindata[includes_idx,:]
@@ -388,8 +382,7 @@ def simulate(traindata, includes_idx, solutions_idx, A):
 
     def shuffle_down(j):
         if j < data.shape[1] - 1:
-            for [src, dst] in reversed(propagate):
-                data[dst,j+1] = data[src,j]
+            data[propagate_dst,j+1] = data[propagate_src,j]
 
     est = []
     next = np.zeros(len(indirect_idx))
@@ -425,7 +418,9 @@ def mass_solution_4(traindata, train_states, output_states, self_reference=False
                 continue
         inputs_idx.append(i)
 
-    A = solve(traindata, inputs_idx, outputs_idx)
+    # all the outputs from one pass (lib/gram.py solve_outputs())
+    fits = gram.solve_outputs(traindata, { i: inputs_idx for i in outputs_idx })
+    A = np.array( [ fits[i]["coeff"] for i in outputs_idx ] )
 
     # direct solution with all current states known, how well does our fit estimate the next state?
     direct_est = A @ traindata[inputs_idx,:]
@@ -452,7 +447,10 @@ def mass_solution_4(traindata, train_states, output_states, self_reference=False
         axs[1].legend()
     plt.show()
 
-def parameter_find_5(traindata, train_states, y_state, include_states, exclude_states, self_reference=False):
+# fast: score the candidates from the Gram matrix of all the terms with
+# incremental Cholesky updates (lib/selection.py) instead of solving every
+# candidate fit, same selection order.  Returns the chosen terms in order.
+def parameter_find_5(traindata, train_states, y_state, include_states, exclude_states, self_reference=False, fast=True):
 
     include_idx = []
     output_idx = train_states.index(y_state)
@@ -487,36 +485,53 @@ def parameter_find_5(traindata, train_states, y_state, include_states, exclude_s
 
     # min_rms = np.std(traindata[output_idx,:])
     min_rms = None
+    y_rms = rms(traindata[output_idx,1:])
+
+    if fast:
+        term_idx = include_idx + [ train_states.index(x) for x in remain_states ]
+        select = selection.ForwardSelection(gram.accumulate(traindata, term_idx, evalout_idx), range(len(include_idx)))
 
     while len(remain_states):
-        for rs in remain_states:
-            print("evaluating:", rs)
-            r_idx = train_states.index(rs)
-            evalin_idx = include_idx + [r_idx]
-
-            A = solve(traindata, evalin_idx, evalout_idx)
-
-            # direct solution with all current states known, how well does our fit estimate the next state?
-            direct_est = A @ traindata[evalin_idx,:]
-            # print("direct_est:", direct_est.shape, direct_est)
-            direct_error = traindata[output_idx,1:] - direct_est[:,:-1]
-            # print("direct_error:", direct_error.shape, direct_error)
-            direct_rms = np.std(direct_error)
-            print("direct_rms:", direct_rms)
-            if min_rms is None or direct_rms < min_rms:
-                min_A = A
-                min_rms = direct_rms
-                min_idx = r_idx
-                min_est = direct_est
-                min_err = direct_error
-                min_evalin_idx = evalin_idx
-
-            print("ERROR Direct:", y_state, "->", rs, rms(direct_error), "%.3f%%" % (100 * rms(direct_error) / rms(traindata[output_idx,1:])))
-            # print("ERROR Sim:", output_states[i], rms(sim_error[i,:]), "%.3f%%" % (100 * rms(sim_error[i,:]) / rms(sim_est[i,:]) ))
-
-        print(rms(min_err), rms(traindata[output_idx,1:]))
+        if fast:
+            candidates = [ term_idx.index(train_states.index(rs)) for rs in remain_states ]
+            best, scores = select.step(candidates)
+            for rs, direct_rms in zip(remain_states, scores):
+                print("ERROR Direct:", y_state, "->", rs, direct_rms, "%.3f%%" % (100 * direct_rms / y_rms))
+            min_idx = train_states.index(remain_states[best])
+            min_rms = scores[best]
+            min_evalin_idx = include_idx + [min_idx]
+            min_A = select.coefficients()[np.newaxis,:]
+            min_est = min_A @ traindata[min_evalin_idx,:]
+            min_err = traindata[output_idx,1:] - min_est[:,:-1]
+        else:
+            for rs in remain_states:
+                print("evaluating:", rs)
+                r_idx = train_states.index(rs)
+                evalin_idx = include_idx + [r_idx]
+
+                A = solve(traindata, evalin_idx, evalout_idx)
+
+                # direct solution with all current states known, how well does our fit estimate the next state?
+                direct_est = A @ traindata[evalin_idx,:]
+                # print("direct_est:", direct_est.shape, direct_est)
+                direct_error = traindata[output_idx,1:] - direct_est[:,:-1]
+                # print("direct_error:", direct_error.shape, direct_error)
+                direct_rms = np.std(direct_error)
+                print("direct_rms:", direct_rms)
+                if min_rms is None or direct_rms < min_rms:
+                    min_A = A
+                    min_rms = direct_rms
+                    min_idx = r_idx
+                    min_est = direct_est
+                    min_err = direct_error
+                    min_evalin_idx = evalin_idx
+
+                print("ERROR Direct:", y_state, "->", rs, rms(direct_error), "%.3f%%" % (100 * rms(direct_error) / y_rms))
+                # print("ERROR Sim:", output_states[i], rms(sim_error[i,:]), "%.3f%%" % (100 * rms(sim_error[i,:]) / rms(sim_est[i,:]) ))
+
+        print(rms(min_err), y_rms)
         print("Best next parameter:", train_states[min_idx], "rms val: %.05f" % min_rms,
-                "error = %.3f%%" % (100 * rms(min_err) / rms(traindata[output_idx,1:])))
+                "error = %.3f%%" % (100 * rms(min_err) / y_rms))
         include_idx.append(min_idx)
         remain_states.remove(train_states[min_idx])
 
@@ -553,6 +568,8 @@ def parameter_find_5(traindata, train_states, y_state, include_states, exclude_s
         axs[1].legend()
         plt.show()
 
+    return [ train_states[i] for i in include_idx ]
+
 def parameter_fit_1(traindata, train_states, input_states, output_states, self_reference=False):
 
     n = len(output_states)
@@ -583,7 +600,9 @@ def parameter_fit_1(traindata, train_states, input_states, output_states, self_r
         plt.plot(traindata[train_states.index(x)], label=train_states[train_states.index(x)])
         plt.legend()
 
-    A = solve(traindata, input_idx, output_idx)
+    # all the outputs from one pass (lib/gram.py solve_outputs())
+    fits = gram.solve_outputs(traindata, { i: input_idx for i in output_idx })
+    A = np.array( [ fits[i]["coeff"] for i in output_idx ] )
 
     # direct solution with all current states known, how well does our fit estimate the next state?
     est = A @ traindata[input_idx,:]
@@ -598,8 +617,7 @@ def parameter_fit_1(traindata, train_states, input_states, output_states, self_r
         error = traindata[idx,1:] - est[i,:-1]
         # print("direct_error:", direct_error.shape, direct_error)
         # rms(error) = np.std(error)
-        rms_perc = 100 * rms(error) / rms(traindata[idx,1:])
-        print(output_states[i], "rms: %.4f" % rms(error), "%.2f%%" % rms_perc)
+        print(output_states[i], "rms: %.4f" % fits[idx]["rms"], "%.2f%%" % fits[idx]["percent"])
 
         terms = ""
         first = True